@@ -0,0 +1,103 @@
+import random
+import sys
+import time
+
+from direct.distributed.PyDatagram import PyDatagram
+from panda3d.core import Datagram
+
+from libpuns.connection.connection_globals import SpecialMessage, SupportedCapabilities
+from libpuns.connection.message_registry import Flags, MsgRegistry
+from libpuns.connection.packers import Float32, Int32
+from libpuns.server.database_interface import DummyDatabaseInterface
+from libpuns.server.server_director import ServerMessageDirector
+from libpuns.server.server_node import SNetworkNode
+from libpuns.server.traffic_replay import ReplayConnection, ReplayTransport
+
+BenchClass = 1000
+
+MsgRegistry.configure(
+    BenchClass, [
+        ('ping', Flags.OwnerSend | Flags.Broadcast, (Int32(), )),
+        ('position', Flags.OwnerSend | Flags.RAM | Flags.Broadcast, (Float32(), Float32(), Float32())),
+    ]
+)
+
+
+class BenchDatabase(DummyDatabaseInterface):
+    def attempt_login(self, login: str, token: str) -> int:
+        return int(login)
+
+
+@MsgRegistry.server_class(BenchClass)
+class BenchPlayer(SNetworkNode):
+    pass
+
+
+def send_special(director: ServerMessageDirector, conn: ReplayConnection, message_type: SpecialMessage,
+                 *fields: tuple[str, ...]) -> None:
+    dg = PyDatagram()
+    dg.addUint16(message_type)
+    for method, value in fields:
+        getattr(dg, method)(value)
+    director.handle_datagram(conn, Datagram(dg.getMessage()))
+
+
+def connect_clients(director: ServerMessageDirector, count: int, grid: int, radius: int) -> None:
+    # Every client lives in a cell of a grid of zones and sees the cells within radius, like an open world
+    rng = random.Random(0)
+    for i in range(count):
+        conn = ReplayConnection(i)
+        director.accept_connection(conn)
+        send_special(director, conn, SpecialMessage.ConnectionRequest, ('addBlob', director.signature),
+                     ('addUint16', MsgRegistry.SchemaVersion), ('addUint32', SupportedCapabilities),
+                     ('addString', str(i + 1)), ('addString', ''))
+
+        x, y = rng.randrange(grid), rng.randrange(grid)
+        send_special(director, conn, SpecialMessage.ZoneRequest, ('addUint32', y * grid + x), ('addUint16', 0))
+        for nx in range(max(0, x - radius), min(grid, x + radius + 1)):
+            for ny in range(max(0, y - radius), min(grid, y + radius + 1)):
+                if (nx, ny) != (x, y):
+                    send_special(director, conn, SpecialMessage.InterestAdd, ('addUint32', ny * grid + nx),
+                                 ('addUint16', 0))
+
+
+def main(count: int = 2000, grid: int = 16, radius: int = 1, updates: int = 20000) -> None:
+    director = ServerMessageDirector(BenchDatabase(), BenchPlayer, snapshot_rate=10)
+    director.compile_signature()
+    transport = director.writer = director.connman = ReplayTransport()
+
+    start = time.perf_counter()
+    connect_clients(director, count, grid, radius)
+    elapsed = time.perf_counter() - start
+    zones_per_client = sum(len(zones) for zones in director.reverse_zone_connections.values()) / count
+    print(f'Subscriptions: {count} clients in {zones_per_client:.1f} zones each on average, set up in {elapsed:.2f}s, '
+          f'{transport.datagrams} datagrams sent')
+
+    players = [director.objects[oid] for oid in sorted(director.identified_connections)]
+    # Sending the update to every zone of the sender separately would reach the clients of overlapping zones twice
+    per_zone = sum(len(director.zone_connections[zone]) for player in players
+                   for zone in director.reverse_zone_connections[player.oid]) / count
+    recipients = sum(len(director.get_zone_recipients(director.reverse_zone_connections[player.oid]))
+                     for player in players) / count
+    print(f'Recipients per broadcast: {recipients:.1f} deduplicated, {per_zone:.1f} when sent per zone')
+
+    transport.datagrams = 0
+    start = time.perf_counter()
+    for i in range(updates):
+        players[i % count].send_update('ping', i)
+    elapsed = time.perf_counter() - start
+    print(f'Broadcasts: {updates} updates in {elapsed:.2f}s, {updates / elapsed:,.0f} updates/s, '
+          f'{transport.datagrams / elapsed:,.0f} datagrams/s')
+
+    transport.datagrams = 0
+    start = time.perf_counter()
+    for i in range(updates):
+        players[i % count].send_update('position', i * 0.5, i * 0.25, 1.0)
+    for zone in list(director.zone_snapshots):
+        director.flush_zone_snapshot(zone)
+    elapsed = time.perf_counter() - start
+    print(f'Snapshots: {updates} coalesced updates flushed in {elapsed:.2f}s, {transport.datagrams} snapshot datagrams')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,87 @@
+import os
+import sys
+import tempfile
+import time
+
+from libpuns.connection.message_registry import Flags, MsgRegistry
+from libpuns.connection.packers import Float32, Int32, String
+from libpuns.server.database_interface import DummyDatabaseInterface
+from libpuns.server.journal import Journal
+from libpuns.server.memory_handler import MemoryHandler, encode_record
+
+BenchClass = 1000
+
+MsgRegistry.configure(
+    BenchClass, [
+        ('position', Flags.RAM, (Float32(), Float32(), Float32())),
+        ('health', Flags.RAM, (Int32(), )),
+        ('name', Flags.RAM, (String(), )),
+    ]
+)
+
+
+def generate_updates(count: int, object_count: int):
+    for i in range(count):
+        oid = i % object_count
+        if i % 3 == 0:
+            yield oid, 'position', (i * 0.5, i * 0.25, 1.0)
+        elif i % 3 == 1:
+            yield oid, 'health', (i % 100, )
+        else:
+            yield oid, 'name', (f'object-{oid}', )
+
+
+def main(count: int = 1000000, object_count: int = 10000) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        journal = Journal(directory)
+        memory = MemoryHandler(DummyDatabaseInterface(), journal)
+        memory.recover()
+
+        updates = list(generate_updates(count, object_count))
+        start = time.perf_counter()
+        for oid, field, value in updates:
+            memory.set_data(oid, field, value, class_number=BenchClass)
+        journal.sync()
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(journal.journal_path)
+        print(f'Journal writes: {count} updates in {elapsed:.2f}s, {count / elapsed:,.0f} updates/s, '
+              f'{size / 2 ** 20:.1f} MiB')
+
+        # The server passes the datagram it already has as the record, this is the cost of the journal alone
+        records = [encode_record(BenchClass, oid, field, value) for oid, field, value in updates]
+        start = time.perf_counter()
+        for record in records:
+            journal.append(record)
+        journal.sync()
+        elapsed = time.perf_counter() - start
+        print(f'Journal appends of encoded records: {count / elapsed:,.0f} records/s')
+        journal.start_journal()
+        for record in records:
+            journal.append(record)
+        journal.close()
+
+        start = time.perf_counter()
+        recovered = MemoryHandler(DummyDatabaseInterface(), Journal(directory))
+        recovered.recover()
+        elapsed = time.perf_counter() - start
+        assert recovered.query_memory == memory.query_memory
+        print(f'Journal recovery: {count} records in {elapsed:.2f}s, {count / elapsed:,.0f} records/s')
+
+        start = time.perf_counter()
+        recovered.journal.write_snapshot(recovered.get_records())
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(recovered.journal.snapshot_path)
+        print(f'Snapshot write: {object_count} objects in {elapsed:.2f}s, {size / 2 ** 20:.1f} MiB')
+        recovered.journal.close()
+
+        start = time.perf_counter()
+        restarted = MemoryHandler(DummyDatabaseInterface(), Journal(directory))
+        restarted.recover()
+        elapsed = time.perf_counter() - start
+        assert restarted.query_memory == memory.query_memory
+        print(f'Snapshot recovery: {object_count} objects in {elapsed:.2f}s')
+        restarted.journal.close()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
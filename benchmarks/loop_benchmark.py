@@ -0,0 +1,167 @@
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import time
+
+from direct.distributed.PyDatagram import PyDatagram
+from direct.distributed.PyDatagramIterator import PyDatagramIterator
+from panda3d.core import Datagram
+
+from libpuns.connection.connection_globals import SpecialMessage
+from libpuns.connection.datagram_util import add_object_id
+from libpuns.connection.message_registry import CallbackObject, Flags, MsgRegistry
+from libpuns.connection.packers import Int32, String
+from libpuns.server.database_interface import DummyDatabaseInterface
+from libpuns.server.server_director import ServerMessageDirector
+from libpuns.server.server_loop import ServerLoop
+from libpuns.server.server_node import SNetworkNode
+
+BenchClass = 1000
+
+MsgRegistry.configure(
+    BenchClass, [
+        CallbackObject('echo', Flags.OwnerSend, (Int32(), ), returns=(Int32(), )),
+        # The CPU time of the server process, sent as a string to keep its precision
+        CallbackObject('cpu_time', Flags.OwnerSend, (), returns=(String(), )),
+    ]
+)
+
+
+class BenchDatabase(DummyDatabaseInterface):
+    def attempt_login(self, login: str, token: str) -> int:
+        return int(login)
+
+
+@MsgRegistry.server_class(BenchClass)
+class BenchPlayer(SNetworkNode):
+    def do_echo(self, value: int) -> int:
+        return value
+
+    def do_cpu_time(self) -> str:
+        return repr(time.process_time())
+
+
+def serve(loop: str, port: int, tick: float) -> None:
+    # Runs in a separate process, so that its CPU time only covers the server
+    director = ServerMessageDirector(BenchDatabase(), BenchPlayer)
+    if loop == 'taskmgr':
+        director.launch(port)
+    else:
+        ServerLoop(director, tick).run(port)
+
+
+class BenchClient:
+    # Speaks the protocol over a plain socket, which keeps the client loop out of the measurements
+    def __init__(self, port: int, oid: int):
+        self.oid = oid
+        self.next_call_id = 1
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        dg = PyDatagram()
+        dg.addUint16(SpecialMessage.ConnectionRequest)
+        dg.addBlob(MsgRegistry.Signature)
+        dg.addUint16(MsgRegistry.SchemaVersion)
+        dg.addUint32(0)
+        dg.addString(str(oid))
+        dg.addString('')
+        self.send(dg)
+        self.receive(SpecialMessage.ConnectionResponse)
+
+    def send(self, dg: PyDatagram) -> None:
+        # Panda3D prefixes the datagrams with their 16-bit length
+        data = dg.getMessage()
+        self.sock.sendall(struct.pack('<H', len(data)) + data)
+
+    def read(self, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('The server closed the connection')
+            data += chunk
+        return data
+
+    def receive(self, message_type: SpecialMessage) -> bytes:
+        while True:
+            data = self.read(struct.unpack('<H', self.read(2))[0])
+            if struct.unpack('<H', data[:2])[0] == message_type:
+                return data
+
+    def call(self, message_type: str, *args):
+        typedef = MsgRegistry.TypeIndex[BenchClass]
+        message_number = typedef.get_message_number(message_type)
+        cfg = typedef.configurations[message_number]
+        arguments = PyDatagram()
+        cfg.pack(arguments, args)
+        dg = PyDatagram()
+        dg.addUint16(SpecialMessage.RpcRequest)
+        dg.addUint16(1)
+        dg.addUint32(self.next_call_id)
+        dg.addUint16(BenchClass)
+        add_object_id(dg, self.oid)
+        dg.addUint16(message_number)
+        dg.addUint16(arguments.getLength())
+        dg.appendData(arguments.getMessage())
+        self.next_call_id += 1
+        self.send(dg)
+
+        datagram = Datagram(self.receive(SpecialMessage.RpcResponse))
+        pdi = PyDatagramIterator(datagram)
+        pdi.skipBytes(2 + 2 + 4 + 1 + 2)
+        return cfg.unpack_returns(pdi)
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+def connect(port: int, oid: int, timeout: float = 10) -> BenchClient:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return BenchClient(port, oid)
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def measure(loop: str, port: int, clients: int, idle: float, round_trips: int, tick: float) -> None:
+    server = subprocess.Popen([sys.executable, '-m', 'benchmarks.loop_benchmark', 'serve', loop, str(port),
+                               str(tick)], stderr=subprocess.DEVNULL)
+    try:
+        players = [connect(port, oid) for oid in range(1, clients + 1)]
+        probe = players[0]
+        start_cpu = float(probe.call('cpu_time'))
+        time.sleep(idle)
+        idle_cpu = float(probe.call('cpu_time')) - start_cpu
+
+        latencies = []
+        for i in range(round_trips):
+            start = time.perf_counter()
+            probe.call('echo', i)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        print(f'{loop}: {idle_cpu / idle:.1%} of a core while idle with {clients} clients, round trip latency '
+              f'median {statistics.median(latencies) * 1e6:.0f} us, '
+              f'p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.0f} us, max {latencies[-1] * 1e6:.0f} us')
+        for player in players:
+            player.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(clients: float = 50, idle: float = 5, round_trips: float = 2000, tick: float = 0.05,
+         port: float = 7299) -> None:
+    MsgRegistry.freeze()
+    for offset, loop in enumerate(('taskmgr', 'select')):
+        measure(loop, int(port) + offset, int(clients), idle, int(round_trips), tick)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']:
+        serve(sys.argv[2], int(sys.argv[3]), float(sys.argv[4]))
+    else:
+        main(*(float(arg) for arg in sys.argv[1:]))
@@ -1,19 +1,31 @@
+import zlib
 from typing import Callable, Type
 
 from direct.distributed.PyDatagram import PyDatagram
 from direct.distributed.PyDatagramIterator import PyDatagramIterator
-from panda3d.core import NetDatagram, PointerToConnection
+from direct.task.Task import Task
+from panda3d.core import Datagram, PointerToConnection
 
 from libpuns.client.client_node import CNetworkNode
+from libpuns.client.object_cache import ObjectCache
+from libpuns.client.snapshot_buffer import SnapshotBuffer
 from libpuns.connection.connection import MessageDirector
-from libpuns.connection.connection_globals import SpecialMessage, KickReason
+from libpuns.connection.connection_globals import SpecialMessage, KickReason, Capability, SupportedCapabilities
 from libpuns.connection.datagram_util import ObjectID, add_object_id, extract_object_id
-from libpuns.connection.message_registry import MsgRegistry
+from libpuns.connection.message_registry import MsgRegistry, Flags
 from libpuns.connection.network_node import NetworkNode
+from libpuns.connection.rpc import RpcFuture
+from libpuns.connection.timer_wheel import TimerWheel
 
 
 class ClientMessageDirector(MessageDirector):
     requested_objects: set[ObjectID]
+    pending_requests: list[ObjectID]
+    buffered_messages: dict[ObjectID, list[Datagram]]
+    object_versions: dict[ObjectID, int]
+    object_sizes: dict[ObjectID, int]
+    # The objects received with the zone data of every zone we see
+    zone_objects: dict[int, set[ObjectID]]
 
     DisconnectionReasons = {
         KickReason.InvalidSignature: 'Outdated client signature',
@@ -26,16 +38,40 @@ class ClientMessageDirector(MessageDirector):
 
         KickReason.InvalidLogin: 'Incorrect login or token',
         KickReason.DoubleLogin: 'Logged in from another place',
+        KickReason.Timeout: 'Connection timed out',
+        KickReason.RateLimited: 'Sent too many messages',
     }
 
-    def __init__(self, player_class: Type[CNetworkNode], on_connect: Callable[[CNetworkNode], None]):
-        super().__init__()
+    ObjectRequestTimeout = 2
+    MaxBufferedMessages = 64
+    # Same limit as the server, Panda3D cannot send datagrams over 64 KiB
+    MaxDatagramSize = 60000
+
+    def __init__(self, player_class: Type[CNetworkNode], on_connect: Callable[[CNetworkNode], None],
+                 interpolation_delay: float | None = None, cache_memory_limit: int = 4 * 1024 * 1024,
+                 capabilities: int = SupportedCapabilities, rpc_timeout: float = 10):
+        super().__init__(rpc_timeout)
         self.class_index = MsgRegistry.ClientTypeIndex
         self.player_class, self.on_connect = player_class, on_connect
         self.avatar = self.connection = None
         self.requested_objects = set()
+        self.pending_requests = []
+        self.buffered_messages = {}
+        self.request_timers = TimerWheel()
+        self.object_versions = {}
+        self.object_sizes = {}
+        self.object_cache = ObjectCache(cache_memory_limit)
+        # The cached versions are only meaningful to the server run that sent them
+        self.server_epoch = None
         self.initialized = False
+        # What we support until the server tells what was negotiated
+        self.capabilities = capabilities
         self.zone = -1
+        self.zones = set()
+        self.zone_objects = {}
+        self.server_tick = 0
+        # interpolation_delay=None applies the snapshots as soon as they arrive
+        self.snapshot_buffer = SnapshotBuffer(self.objects, interpolation_delay) if interpolation_delay else None
 
         self.register_special(SpecialMessage.ConnectionResponse, self.handle_connection_response)
         self.register_special(SpecialMessage.Disconnect, self.handle_disconnect)
@@ -43,6 +79,26 @@ class ClientMessageDirector(MessageDirector):
         self.register_special(SpecialMessage.ObjectResponse, self.handle_object_response)
         self.register_special(SpecialMessage.TransferOwner, self.handle_transfer_owner)
         self.register_special(SpecialMessage.ZoneData, self.handle_zone_data)
+        self.register_special(SpecialMessage.Snapshot, self.handle_snapshot)
+        self.register_special(SpecialMessage.Compressed, self.handle_compressed)
+        self.register_special(SpecialMessage.Heartbeat, self.handle_heartbeat)
+        self.register_special(SpecialMessage.ObjectLeave, self.handle_object_leave)
+
+    def handle_object_leave(self, conn: PointerToConnection, pdi: PyDatagramIterator) -> None:
+        oid = extract_object_id(pdi)
+        for objects in self.zone_objects.values():
+            objects.discard(oid)
+        if oid != self.avatar.oid:
+            self.cache_object(oid)
+
+    def handle_heartbeat(self, conn: PointerToConnection, pdi: PyDatagramIterator) -> None:
+        dg = PyDatagram()
+        dg.addUint16(SpecialMessage.Heartbeat)
+        dg.addUint32(pdi.getUint32())
+        self.send_datagram(dg)
+
+    def handle_compressed(self, conn: PointerToConnection, pdi: PyDatagramIterator) -> None:
+        self.handle_datagram(conn, Datagram(zlib.decompress(pdi.getBlob32())))
 
     def handle_transfer_owner(self, conn: PointerToConnection, pdi: PyDatagramIterator) -> None:
         oid = extract_object_id(pdi)
@@ -50,27 +106,104 @@ class ClientMessageDirector(MessageDirector):
 
     def handle_zone_data(self, conn: PointerToConnection, pdi: PyDatagramIterator) -> None:
         zone_id = pdi.getUint32()
+        if zone_id not in self.zones:
+            # Sent before the server knew we left the zone
+            return
+
         print(f'Received zone data for zone {zone_id}')
-        self.zone = zone_id
+        zone_objects = self.zone_objects.setdefault(zone_id, set())
+        for i in range(pdi.getUint16()):
+            # Members we already see through another zone, unless we cached them since and dropped their updates
+            oid = extract_object_id(pdi)
+            zone_objects.add(oid)
+            if oid not in self.objects:
+                self.request_object(oid)
         object_count = pdi.getUint16()
         for i in range(object_count):
-            self.handle_object_response(conn, pdi)
+            zone_objects.add(self.handle_object_data(conn, pdi))
+
+    def handle_snapshot(self, conn: PointerToConnection, pdi: PyDatagramIterator) -> None:
+        tick = pdi.getUint32()
+        self.server_tick = max(self.server_tick, tick)
+        entry_count = pdi.getUint16()
+        buffered_entries = []
+        for i in range(entry_count):
+            class_number = pdi.getUint16()
+            oid = extract_object_id(pdi)
+            obj = self.objects.get(oid)
+            if obj is None:
+                # Still need to read the entry to get to the next one. Snapshots only carry RAM fields,
+                # which the object response will include, so there is nothing to replay.
+                MsgRegistry.TypeIndex[class_number].decompile_datagram(pdi)
+                self.request_object_data(conn, None, oid)
+                continue
+
+            if obj.ClassNumber != class_number:
+                raise ValueError(f'Received invalid object type: expected {obj.ClassNumber}, got {class_number}.')
+
+            if self.snapshot_buffer is None:
+                self.decompile_datagram(conn, obj, pdi)
+            else:
+                typedef = MsgRegistry.TypeIndex[class_number]
+                msg_name, msg_data = typedef.decompile_datagram(pdi)
+                interpolate = typedef.get_flags(msg_name) & Flags.Interpolate != 0
+                buffered_entries.append((oid, msg_name, msg_data, interpolate))
+
+        if self.snapshot_buffer is not None:
+            self.snapshot_buffer.add_snapshot(tick, buffered_entries)
+
+    def poll_snapshots(self, task: Task):
+        self.snapshot_buffer.update()
+        return task.cont
 
     def handle_object_response(self, conn: PointerToConnection, pdi: PyDatagramIterator) -> None:
+        object_count = pdi.getUint16()
+        for i in range(object_count):
+            self.handle_object_data(conn, pdi)
+
+    def handle_object_data(self, conn: PointerToConnection, pdi: PyDatagramIterator) -> ObjectID:
+        start = pdi.getCurrentIndex()
         oid = extract_object_id(pdi)
         if oid in self.requested_objects:
             self.requested_objects.remove(oid)
+            self.request_timers.cancel(oid)
 
         class_number = pdi.getUint16()
-        if oid not in self.objects:
-            obj = MsgRegistry.ClientIndex[class_number](self, oid) if oid != self.avatar.oid else self.avatar
-            self.objects[oid] = obj
-        else:
+        if oid in self.objects:
             obj = self.objects[oid]
+        elif oid == self.avatar.oid:
+            obj = self.objects[oid] = self.avatar
+        else:
+            cached = self.object_cache.take(oid)
+            if cached is not None and cached.obj.ClassNumber == class_number:
+                obj = cached.obj
+                self.object_sizes[oid] = cached.size
+            else:
+                if cached is not None:
+                    cached.obj.ignoreAll()
+                obj = MsgRegistry.ClientIndex[class_number](self, oid)
+            self.objects[oid] = obj
 
+        if self.snapshot_buffer is not None:
+            self.snapshot_buffer.forget(oid)
+        self.object_versions[oid] = pdi.getUint32()
         field_count = pdi.getUint16()
         for i in range(field_count):
             self.decompile_datagram(conn, obj, pdi)
+        self.object_sizes[oid] = max(self.object_sizes.get(oid, 0), pdi.getCurrentIndex() - start)
+
+        for message in self.buffered_messages.pop(oid, ()):
+            self.replay_message(conn, message)
+        return oid
+
+    def replay_message(self, conn: PointerToConnection, message: Datagram) -> None:
+        # The object response was sent after the buffered messages, so it already has the RAM fields they set
+        pdi = PyDatagramIterator(message)
+        typedef = MsgRegistry.TypeIndex[pdi.getUint16()]
+        extract_object_id(pdi)
+        _, cfg = typedef.get_message_data(pdi.getUint16())
+        if not cfg.flags & Flags.RAM:
+            self.handle_datagram(conn, message)
 
     def handle_zone_response(self, conn: PointerToConnection, pdi: PyDatagramIterator) -> None:
         self.zone = pdi.getUint32()
@@ -92,17 +225,103 @@ class ClientMessageDirector(MessageDirector):
     def send_datagram_to(self, obj: ObjectID | NetworkNode, flags: int, datagram: PyDatagram, **kwargs) -> None:
         self.send_datagram(datagram)
 
+    def send_rpc(self, obj: NetworkNode, message_type: str, args: tuple[...], timeout: float = None) -> RpcFuture:
+        if not self.connection:
+            raise ConnectionError('Not connected.')
+
+        typedef = MsgRegistry.TypeIndex[obj.ClassNumber]
+        message_number = typedef.get_message_number(message_type)
+        cfg = typedef.configurations[message_number]
+        if cfg.return_types is None:
+            raise ValueError(f'{message_type} is not a remote call')
+
+        return self.rpc.call(self.connection, obj.ClassNumber, obj.oid, message_number, message_type, cfg, args,
+                             timeout)
+
+    def poll_rpc(self, task: Task):
+        self.rpc.expire()
+        self.rpc.flush(lambda conn, datagram: self.send_datagram(datagram))
+        return task.cont
+
     def handle_connection_response(self, conn: PointerToConnection, pdi: PyDatagramIterator) -> None:
         user_id = extract_object_id(pdi)
         zone_id = pdi.getUint32()
+        tick_rate = pdi.getUint16()
+        self.capabilities = pdi.getUint32()
+        epoch = pdi.getUint32()
+        if epoch != self.server_epoch:
+            self.object_cache.clear()
+            self.server_epoch = epoch
         self.avatar = self.player_class(self, user_id)
+        if self.snapshot_buffer is not None:
+            self.snapshot_buffer.set_tick_rate(tick_rate)
         # self.on_connect(self.avatar)
+        self.request_zone(zone_id)
+
+    def cache_object(self, oid: ObjectID) -> None:
+        obj = self.objects.pop(oid, None)
+        if self.snapshot_buffer is not None:
+            self.snapshot_buffer.forget(oid)
+        if obj is not None:
+            self.object_cache.put(obj, self.object_versions.pop(oid, 0), self.object_sizes.pop(oid, 0))
+
+    def request_zone(self, zone_id: int) -> None:
+        # Everything we can see now goes to the cache, objects present in the new zone are taken back from it
+        for oid, obj in list(self.objects.items()):
+            if obj is not self.avatar:
+                self.cache_object(oid)
+        self.zones = {zone_id}
+        self.zone_objects = {}
+        self.send_zone_request(SpecialMessage.ZoneRequest, zone_id)
+
+    def add_interest(self, zone_id: int) -> None:
+        # Also see the objects of another zone, the server only sends the ones we do not see yet
+        if zone_id in self.zones:
+            return
+
+        self.zones.add(zone_id)
+        self.send_zone_request(SpecialMessage.InterestAdd, zone_id)
+
+    def remove_interest(self, zone_id: int) -> None:
+        if zone_id not in self.zones:
+            return
+        if len(self.zones) == 1:
+            raise ValueError('Cannot leave the last zone, use request_zone to move to another one')
+
+        self.zones.remove(zone_id)
+        removed = self.zone_objects.pop(zone_id, set())
+        for objects in self.zone_objects.values():
+            removed.difference_update(objects)
+        for oid in removed:
+            if oid != self.avatar.oid:
+                self.cache_object(oid)
 
         dg = PyDatagram()
-        dg.addUint16(SpecialMessage.ZoneRequest)
+        dg.addUint16(SpecialMessage.InterestRemove)
         dg.addUint32(zone_id)
         self.send_datagram(dg)
 
+    def send_zone_request(self, message_type: SpecialMessage, zone_id: int) -> None:
+        dg = PyDatagram()
+        dg.addUint16(message_type)
+        dg.addUint32(zone_id)
+        entries = PyDatagram()
+        count = 0
+        if self.capabilities & Capability.DeltaEncoding:
+            # As many cached objects as fit in the datagram
+            for oid, version in self.object_cache.get_versions():
+                entry = PyDatagram()
+                add_object_id(entry, oid)
+                entry.addUint32(version)
+                if dg.getLength() + 2 + entries.getLength() + entry.getLength() > self.MaxDatagramSize \
+                        or count == 0xFFFF:
+                    break
+                entries.appendData(entry.getMessage())
+                count += 1
+        dg.addUint16(count)
+        dg.appendData(entries.getMessage())
+        self.send_datagram(dg)
+
     def connect(self, host: str, port: int, login: str, password: str) -> None:
         self.compile_signature()
         connection = self.connman.openTCPClientConnection(host, port, 3000)
@@ -112,10 +331,16 @@ class ClientMessageDirector(MessageDirector):
         self.connection = connection
         self.reader.addConnection(connection)
         self.start_reader()
+        taskMgr.add(self.flush_object_requests, 'Send the batched object requests', -35)
+        taskMgr.add(self.poll_rpc, 'Send the batched remote calls', -34)
+        if self.snapshot_buffer is not None:
+            taskMgr.add(self.poll_snapshots, 'Apply the buffered snapshots', -38)
 
         dg = PyDatagram()
         dg.addUint16(SpecialMessage.ConnectionRequest)
         dg.addBlob(self.signature)
+        dg.addUint16(MsgRegistry.SchemaVersion)
+        dg.addUint32(self.capabilities)
         dg.addString(login)
         dg.addString(password)
         self.send_datagram(dg)
@@ -124,13 +349,53 @@ class ClientMessageDirector(MessageDirector):
         if oid in self.requested_objects:
             self.requested_objects.remove(oid)
 
-    def request_object_data(self, message: NetDatagram, oid: ObjectID):
+        dropped = self.buffered_messages.pop(oid, ())
+        if dropped:
+            self.notify.warning(f'Object {oid} was not received, dropping {len(dropped)} messages')
+
+    def request_object_data(self, conn: PointerToConnection, message: Datagram | None, oid: ObjectID):
+        if oid in self.object_cache:
+            # Left our view, the server stops sending its updates once it handles the zone change
+            return
+
+        if message is not None:
+            buffered = self.buffered_messages.setdefault(oid, [])
+            if len(buffered) < self.MaxBufferedMessages:
+                buffered.append(message)
+        self.request_object(oid)
+
+    def request_object(self, oid: ObjectID) -> None:
         if oid in self.requested_objects:
             return
 
         self.requested_objects.add(oid)
-        taskMgr.doMethodLater(2, self.uncache, f'CMD.uncache_{oid}', extraArgs=[oid])
+        self.request_timers.schedule(oid, self.ObjectRequestTimeout)
+        self.pending_requests.append(oid)
+
+    def flush_object_requests(self, task: Task):
+        for oid in self.request_timers.advance():
+            self.uncache(oid)
+
+        dg = count = None
+        for oid in self.pending_requests:
+            entry = PyDatagram()
+            add_object_id(entry, oid)
+            if dg is None or dg.getLength() + entry.getLength() > self.MaxDatagramSize or count == 0xFFFF:
+                if dg is not None:
+                    self.send_object_request(dg, count)
+                dg, count = PyDatagram(), 0
+
+            dg.appendData(entry.getMessage())
+            count += 1
+
+        if dg is not None:
+            self.send_object_request(dg, count)
+        self.pending_requests.clear()
+        return task.cont
+
+    def send_object_request(self, oids: PyDatagram, count: int) -> None:
         dg = PyDatagram()
         dg.addUint16(SpecialMessage.ObjectRequest)
-        add_object_id(dg, oid)
+        dg.addUint16(count)
+        dg.appendData(oids.getMessage())
         self.send_datagram(dg)
@@ -0,0 +1,56 @@
+from collections import OrderedDict
+from typing import Iterator
+
+from libpuns.connection.datagram_util import ObjectID
+from libpuns.connection.network_node import NetworkNode
+
+
+class CachedObject:
+    def __init__(self, obj: NetworkNode, version: int, size: int):
+        self.obj = obj
+        self.version = version
+        self.size = size
+
+
+class ObjectCache:
+    # Objects that left the client's view, kept so that re-entering a zone only downloads what changed.
+    # The size of an object is estimated by the wire size of its state, evicting the least recently used
+    # objects once memory_limit bytes are exceeded.
+    entries: OrderedDict[ObjectID, CachedObject]
+
+    def __init__(self, memory_limit: int):
+        self.memory_limit = memory_limit
+        self.memory_used = 0
+        self.entries = OrderedDict()
+
+    def put(self, obj: NetworkNode, version: int, size: int) -> None:
+        self.take(obj.oid)
+        self.entries[obj.oid] = CachedObject(obj, version, size)
+        self.memory_used += size
+        while self.memory_used > self.memory_limit and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.memory_used -= evicted.size
+            evicted.obj.ignoreAll()
+
+    def take(self, oid: ObjectID) -> CachedObject | None:
+        entry = self.entries.pop(oid, None)
+        if entry is not None:
+            self.memory_used -= entry.size
+        return entry
+
+    def clear(self) -> None:
+        for entry in self.entries.values():
+            entry.obj.ignoreAll()
+        self.entries.clear()
+        self.memory_used = 0
+
+    def get_versions(self) -> Iterator[tuple[ObjectID, int]]:
+        # Most recently used first, so a truncated advertisement keeps the likeliest hits
+        for oid in reversed(self.entries):
+            yield oid, self.entries[oid].version
+
+    def __contains__(self, oid: ObjectID) -> bool:
+        return oid in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,109 @@
+import time
+from collections import deque
+from typing import Any
+
+from libpuns.connection.datagram_util import ObjectID
+from libpuns.connection.network_node import NetworkNode
+
+
+FieldKey = tuple[ObjectID, str]
+Sample = tuple[int, tuple[...]]
+
+
+def interpolate_value(a: Any, b: Any, t: float) -> Any:
+    if isinstance(a, bool) or not isinstance(a, (int, float)) or not isinstance(b, (int, float)):
+        return a
+    value = a + (b - a) * t
+    return round(value) if isinstance(a, int) else value
+
+
+class SnapshotBuffer:
+    # Holds snapshot entries for `delay` seconds of server time before applying them, so that the updates
+    # are applied at a steady pace no matter how the datagrams arrive. Fields flagged Interpolate are
+    # blended between the two samples surrounding the render time and applied every frame.
+    samples: dict[FieldKey, deque[Sample]]
+    applied: dict[FieldKey, tuple[...]]
+    # The interpolated fields of every object, to forget them along with the object
+    object_fields: dict[ObjectID, set[str]]
+    discrete: deque[tuple[int, ObjectID, str, tuple[...]]]
+
+    # Share of the gap closed per snapshot when the server clock estimate has to move back
+    OffsetSmoothing = 0.05
+
+    def __init__(self, objects: dict[ObjectID, NetworkNode], delay: float):
+        self.objects = objects
+        self.delay = delay
+        self.tick_rate = None
+        self.clock_offset = None
+        self.samples = {}
+        self.applied = {}
+        self.object_fields = {}
+        self.discrete = deque()
+
+    def set_tick_rate(self, tick_rate: int) -> None:
+        self.tick_rate = tick_rate or None
+
+    def add_snapshot(self, tick: int, entries: list[tuple[ObjectID, str, tuple[...], bool]], now: float = None) -> None:
+        now = time.monotonic() if now is None else now
+        if self.tick_rate:
+            # The server clock estimate follows the least delayed snapshot, and only slowly drifts back down
+            sample = tick / self.tick_rate - now
+            if self.clock_offset is None or sample > self.clock_offset:
+                self.clock_offset = sample
+            else:
+                self.clock_offset += (sample - self.clock_offset) * self.OffsetSmoothing
+
+        for oid, msg_name, args, interpolate in entries:
+            if interpolate:
+                self.samples.setdefault((oid, msg_name), deque()).append((tick, args))
+                self.object_fields.setdefault(oid, set()).add(msg_name)
+            else:
+                self.discrete.append((tick, oid, msg_name, args))
+
+    def forget(self, oid: ObjectID) -> None:
+        # Called when the object leaves our view or its full state arrives, older samples must not be blended in
+        for msg_name in self.object_fields.pop(oid, ()):
+            self.samples.pop((oid, msg_name), None)
+            self.applied.pop((oid, msg_name), None)
+        if any(entry[1] == oid for entry in self.discrete):
+            self.discrete = deque(entry for entry in self.discrete if entry[1] != oid)
+
+    def get_render_tick(self, now: float) -> float | None:
+        if self.clock_offset is None:
+            return None
+        return (now + self.clock_offset - self.delay) * self.tick_rate
+
+    def apply(self, oid: ObjectID, msg_name: str, args: tuple[...]) -> None:
+        obj = self.objects.get(oid)
+        if obj is not None:
+            getattr(obj, f'do_{msg_name}')(*args)
+
+    def update(self, now: float = None) -> None:
+        now = time.monotonic() if now is None else now
+        render_tick = self.get_render_tick(now)
+        if render_tick is None:
+            return
+
+        while self.discrete and self.discrete[0][0] <= render_tick:
+            _, oid, msg_name, args = self.discrete.popleft()
+            self.apply(oid, msg_name, args)
+
+        for key in list(self.samples):
+            samples = self.samples[key]
+            while len(samples) > 1 and samples[1][0] <= render_tick:
+                samples.popleft()
+
+            start_tick, start_args = samples[0]
+            if start_tick > render_tick:
+                continue
+
+            # With a single sample we ran out of data: hold the last value, it stays as the next starting point
+            args = start_args
+            if len(samples) > 1:
+                end_tick, end_args = samples[1]
+                t = (render_tick - start_tick) / (end_tick - start_tick)
+                args = tuple(interpolate_value(a, b, t) for a, b in zip(start_args, end_args))
+
+            if self.applied.get(key) != args:
+                self.applied[key] = args
+                self.apply(*key, args)
@@ -1,5 +1,4 @@
 import abc
-import hashlib
 from typing import Callable
 
 from direct.directnotify.DirectNotifyGlobal import directNotify
@@ -7,12 +6,13 @@ from direct.distributed.PyDatagramIterator import PyDatagramIterator
 from direct.showbase.DirectObject import DirectObject
 from direct.task.Task import Task
 from panda3d.core import QueuedConnectionManager, ConnectionWriter, QueuedConnectionReader, NetDatagram, \
-    PointerToConnection
+    PointerToConnection, Datagram
 
 from libpuns.connection.connection_globals import SpecialMessage
-from libpuns.connection.datagram_util import extract_object_id, ObjectID, SClassDef
+from libpuns.connection.datagram_util import extract_object_id, CallbackConfig, ObjectID, SClassDef
 from libpuns.connection.message_registry import MsgRegistry
 from libpuns.connection.network_node import NetworkNode
+from libpuns.connection.rpc import RpcFuture, RpcManager, RpcStatus
 
 
 SpecialCallback = Callable[[PointerToConnection, PyDatagramIterator], None]
@@ -24,7 +24,11 @@ class MessageDirector(DirectObject):
     signature: bytes
     notify = directNotify.newCategory('MessageDirector')
 
-    def __init__(self):
+    # Datagrams handled per poll_reader call, the rest wait for the next frame so that a flood of datagrams
+    # cannot hold back the ticks and the other tasks of the frame
+    MaxReadsPerFrame = 1024
+
+    def __init__(self, rpc_timeout: float = 10):
         super().__init__()
         self.type_index = MsgRegistry.TypeIndex
 
@@ -34,37 +38,53 @@ class MessageDirector(DirectObject):
         self.objects = {}
         self.special_messages = {sm: None for sm in SpecialMessage}
         self.signature = b''
+        # Whether poll_reader left datagrams in the reader because of MaxReadsPerFrame
+        self.reader_backlog = False
+        self.rpc = RpcManager(rpc_timeout)
+
+        self.register_special(SpecialMessage.RpcRequest, self.handle_rpc_request)
+        self.register_special(SpecialMessage.RpcResponse, self.handle_rpc_response)
 
     def register_special(self, message_type: SpecialMessage, callback: SpecialCallback) -> None:
         self.special_messages[message_type] = callback
 
     def compile_signature(self) -> None:
-        signature_str = MsgRegistry.get_signature()
-        h = hashlib.new('sha256')
-        h.update(signature_str.encode('utf-8'))
-        self.signature = h.digest()
+        MsgRegistry.freeze()
+        self.signature = MsgRegistry.Signature
 
     def poll_reader(self, task: Task):
-        if self.reader.dataAvailable():
+        # Reading a single datagram per frame would cap the throughput at the frame rate
+        for i in range(self.MaxReadsPerFrame):
+            if not self.reader.dataAvailable():
+                self.reader_backlog = False
+                break
             datagram = NetDatagram()
-            if self.reader.getData(datagram):
-                self.parse_message(datagram)
+            if not self.reader.getData(datagram):
+                self.reader_backlog = False
+                break
+            self.parse_message(datagram)
+        else:
+            self.reader_backlog = self.reader.dataAvailable()
         return task.cont
 
     def start_reader(self) -> None:
         taskMgr.add(self.poll_reader, 'Poll the connection reader', -40)
 
     @abc.abstractmethod
-    def request_object_data(self, message: NetDatagram, oid: ObjectID):
+    def request_object_data(self, conn: PointerToConnection, datagram: Datagram | None, oid: ObjectID):
         pass
 
     def parse_message(self, message: NetDatagram) -> None:
-        pdi = PyDatagramIterator(message)
+        self.handle_datagram(message.getConnection(), message)
+
+    def handle_datagram(self, conn: PointerToConnection, datagram: Datagram) -> None:
+        # Split from parse_message so that datagrams can be fed without a Panda3D connection
+        pdi = PyDatagramIterator(datagram)
         message_type = pdi.getUint16()
         if message_type in self.special_messages:
             special_callback = self.special_messages.get(message_type)
             if special_callback:
-                special_callback(message.getConnection(), pdi)
+                special_callback(conn, pdi)
                 return
 
             raise ValueError(f'Unknown special message type: {message_type}')
@@ -72,16 +92,49 @@ class MessageDirector(DirectObject):
         oid = extract_object_id(pdi)
         if oid not in self.objects:
             self.notify.warning(f'Received message for unknown object: {oid}')
-            self.request_object_data(message, oid)
+            self.request_object_data(conn, datagram, oid)
             return
 
         obj = self.objects[oid]
         if obj.ClassNumber != message_type:
             raise ValueError(f'Received invalid object type: expected {obj.ClassNumber}, got {message_type}.')
 
-        self.decompile_datagram(message.getConnection(), obj, pdi)
+        self.decompile_datagram(conn, obj, pdi)
 
     def decompile_datagram(self, conn: PointerToConnection, obj: NetworkNode, pdi: PyDatagramIterator) -> None:
         typedef = MsgRegistry.TypeIndex[obj.ClassNumber]
         msg_name, msg_data = typedef.decompile_datagram(pdi)
         getattr(obj, f'do_{msg_name}')(*msg_data)
+
+    def handle_rpc_request(self, conn: PointerToConnection, pdi: PyDatagramIterator) -> None:
+        for call_id, class_number, oid, message_number, data in self.rpc.read_requests(pdi):
+            obj = self.objects.get(oid)
+            if obj is None or obj.ClassNumber != class_number:
+                self.rpc.reject(conn, call_id, RpcStatus.Rejected, f'Unknown object {oid}')
+            elif not self.start_remote_call(conn, call_id, obj, message_number, data):
+                return
+
+    def start_remote_call(self, conn: PointerToConnection, call_id: int, obj: NetworkNode, message_number: int,
+                          data: bytes) -> bool:
+        # Returns False if the connection was dropped, and the rest of the batch must be ignored
+        typedef = MsgRegistry.TypeIndex[obj.ClassNumber]
+        cfg = typedef.configurations.get(message_number)
+        if cfg is None or cfg.return_types is None:
+            self.rpc.reject(conn, call_id, RpcStatus.Rejected, f'Message {message_number} is not a remote call')
+            return True
+
+        self.run_remote_call(conn, call_id, obj, typedef.get_message_name(message_number), cfg,
+                             self.rpc.unpack_args(cfg, data))
+        return True
+
+    def run_remote_call(self, conn: PointerToConnection, call_id: int, obj: NetworkNode, msg_name: str,
+                        cfg: CallbackConfig, args: tuple[...]) -> None:
+        result = RpcFuture()
+        try:
+            result.set_result(getattr(obj, f'do_{msg_name}')(*args))
+        except Exception as e:
+            result.set_exception(e)
+        self.rpc.complete(conn, call_id, cfg, result)
+
+    def handle_rpc_response(self, conn: PointerToConnection, pdi: PyDatagramIterator) -> None:
+        self.rpc.handle_responses(conn, pdi)
@@ -1,22 +1,67 @@
-from enum import IntEnum, auto
+from enum import IntEnum, IntFlag, auto
 
 
 class SpecialMessage(IntEnum):
-    # Sent by the client when connecting. Stores the signature hash (int64) and the login data (string + string).
+    # Sent by the client when connecting. Stores the signature hash (blob), the schema version (uint16),
+    # the supported capabilities (uint32) and the login data (string + string).
     ConnectionRequest = auto()
-    # Sent by the server when the connection is complete. Stores the user ID (three int32s) and a zone ID (int32)
+    # Sent by the server when the connection is complete. Stores the user ID (three int32s), a zone ID (int32),
+    # the server tick rate (uint16), the negotiated capabilities (uint32) and the memory epoch (uint32), which
+    # changes when the server restarts and invalidates the cached object versions.
     ConnectionResponse = auto()
-    # Sent by the client to trigger object visibility.
+    # Sent by the client to trigger object visibility. Stores the zone ID (uint32) and the cached objects
+    # (uint16 count of ObjectID + uint32 version), so that only the fields changed since are sent back.
     ZoneRequest = auto()
     ZoneResponse = auto()
     # Sent by the server before the user is kicked. Stores the kick reason (int8).
     Disconnect = auto()
     # ObjectUpdate is sent using (NodeType uint16, OId ObjectID, Method uint8, *data)
     # this is sent when a user receives a signal that does not have the object in memory
+    # Stores the requested objects (uint16 count of ObjectID), batched once per frame
     ObjectRequest = auto()
+    # Stores the object count (uint16), then for every object the ObjectID, the class (uint16),
+    # the state version (uint32) and the field updates (uint16 count)
     ObjectResponse = auto()
     TransferOwner = auto()
+    # Stores the zone ID (uint32), the members of the zone the client already sees (uint16 count, then their
+    # ObjectIDs), then the other members laid out like ObjectResponse.
     ZoneData = auto()
+    # Sent by the server at the zone send rate. Stores the server tick (uint32), the entry count (uint16)
+    # and the coalesced RAM updates, each laid out as a regular object update.
+    Snapshot = auto()
+    # Sent instead of a large datagram if Capability.Compression was negotiated. Stores the zlib-compressed datagram.
+    Compressed = auto()
+    # Sent by the server to identified clients every heartbeat interval and echoed back by them.
+    # Stores the server send time in milliseconds (uint32, wrapping), used to measure the round trip.
+    Heartbeat = auto()
+    # Sent by the client to see another zone without leaving the current ones, laid out like ZoneRequest.
+    # The server answers with the ZoneData of that zone, only listing the objects the client already sees.
+    InterestAdd = auto()
+    # Sent by the client to stop seeing a zone. Stores the zone ID (uint32), the last zone cannot be removed.
+    InterestRemove = auto()
+    # Sent by the server when an object left every zone the client sees. Stores the ObjectID.
+    ObjectLeave = auto()
+    # Remote calls, sent by either side and batched once per frame. Stores the call count (uint16), then for
+    # every call the call ID (uint32), the class (uint16), the ObjectID, the message number (uint16), the size
+    # of the arguments (uint16) and the arguments.
+    RpcRequest = auto()
+    # Stores the response count (uint16), then for every response the call ID (uint32), the RpcStatus (uint8),
+    # the size of the payload (uint16) and the payload: the return values, or the error message (string).
+    RpcResponse = auto()
+
+
+class Capability(IntFlag):
+    Compression = 1
+    # Snapshots are bundled into one datagram, otherwise their entries are sent as separate updates
+    Bundling = 2
+    # Zone requests advertise the cached object versions and only changed fields are sent back
+    DeltaEncoding = 4
+    # Reserved, not implemented yet
+    UDPChannel = 8
+    CompactIDs = 16
+
+
+SupportedCapabilities = Capability.Compression | Capability.Bundling | Capability.DeltaEncoding
 
 
 class KickReason(IntEnum):
@@ -30,3 +75,5 @@ class KickReason(IntEnum):
 
     InvalidLogin = auto()
     DoubleLogin = auto()
+    Timeout = auto()
+    RateLimited = auto()
@@ -4,6 +4,8 @@ from typing import Sequence, Any
 from direct.distributed.PyDatagram import PyDatagram
 from direct.distributed.PyDatagramIterator import PyDatagramIterator
 
+from libpuns.connection.rate_limit import RateLimit
+
 ObjectID = tuple[int, int, int] | int
 
 
@@ -40,11 +42,16 @@ def add_object_id(dg: PyDatagram, oid: ObjectID) -> None:
 class CallbackConfig:
     arg_types: list[Packable]
 
-    def __init__(self, flags: int, args: Sequence[Packable], default_value=None):
+    def __init__(self, flags: int, args: Sequence[Packable], default_value=None, rate_limit: RateLimit = None,
+                 returns: Sequence[Packable] = None):
         self.flags = flags
         self.arg_types = list(args)
+        # Messages with return types are remote calls, answered with the value returned by their handler
+        self.return_types = None if returns is None else list(returns)
 
         self.default = default_value
+        # Only enforced by the server, so it is not part of the signature
+        self.rate_limit = rate_limit
 
     def pack(self, message: PyDatagram, args: tuple[...]) -> None:
         for arg, arg_type in zip(args, self.arg_types):
@@ -53,8 +60,23 @@ class CallbackConfig:
     def unpack(self, pdi: PyDatagramIterator) -> tuple[...]:
         return tuple(arg_type.unpack(pdi) for arg_type in self.arg_types)
 
+    def pack_returns(self, message: PyDatagram, value) -> None:
+        # A single return value is returned as is, several ones as a tuple
+        values = (value, ) if len(self.return_types) == 1 else value or ()
+        for item, return_type in zip(values, self.return_types):
+            return_type.pack(message, item)
+
+    def unpack_returns(self, pdi: PyDatagramIterator):
+        values = tuple(return_type.unpack(pdi) for return_type in self.return_types)
+        if len(values) == 1:
+            return values[0]
+        return values or None
+
     def get_signature(self) -> str:
-        return f'C-{self.flags}-' + '|'.join(arg_type.get_signature() for arg_type in self.arg_types)
+        signature = f'C-{self.flags}-' + '|'.join(arg_type.get_signature() for arg_type in self.arg_types)
+        if self.return_types is not None:
+            signature += '=>' + '|'.join(return_type.get_signature() for return_type in self.return_types)
+        return signature
 
 
 class SClassDef:
@@ -62,12 +84,17 @@ class SClassDef:
     message_types: dict[int, str]
     configurations: dict[int, CallbackConfig]
     conf_index: list[tuple[str, int, CallbackConfig]]
+    message_flags: dict[str, int]
 
     def __init__(self):
         self.message_numbers = {}
         self.message_types = {}
         self.configurations = {}
         self.conf_index = []
+        self.message_flags = {}
+
+    def freeze(self) -> None:
+        self.message_flags = {name: cfg.flags for name, number, cfg in self.conf_index}
 
     def add_message(self, message_type: str, message_number: int, cfg: CallbackConfig) -> None:
         self.message_numbers[message_type] = message_number
@@ -100,4 +127,7 @@ class SClassDef:
         return 'S-' + '~'.join(f'{k}:{v.get_signature()}' for k, v in self.configurations.items())
 
     def get_flags(self, message_type: str) -> int:
-        return self.configurations[self.message_numbers[message_type]].flags
+        flags = self.message_flags.get(message_type)
+        if flags is None:
+            return self.configurations[self.message_numbers[message_type]].flags
+        return flags
@@ -1,20 +1,29 @@
+import hashlib
+from contextlib import contextmanager
 from enum import IntEnum, auto
-from typing import Sequence, Type
+from typing import Callable, Iterator, Sequence, Type
 
+from libpuns.connection.connection_globals import SpecialMessage
 from libpuns.connection.datagram_util import SClassDef, CallbackConfig
 from libpuns.connection.network_node import NetworkNode
 from libpuns.connection.packers import Packable
+from libpuns.connection.rate_limit import RateLimit
 
 
 class CallbackObject:
-    def __init__(self, name: str, flags: int, packables: Sequence[Packable], default_value=None):
+    def __init__(self, name: str, flags: int, packables: Sequence[Packable], default_value=None,
+                 rate_limit: RateLimit = None, returns: Sequence[Packable] = None):
         self.name = name
         self.flags = flags
         self.packables = packables
         self.default_value = default_value
+        self.rate_limit = rate_limit
+        # Makes the message a remote call, see NetworkNode.call
+        self.returns = returns
 
     def make_tuple(self) -> tuple[str, CallbackConfig]:
-        return self.name, CallbackConfig(self.flags, self.packables, default_value=self.default_value)
+        return self.name, CallbackConfig(self.flags, self.packables, default_value=self.default_value,
+                                         rate_limit=self.rate_limit, returns=self.returns)
 
 
 CallbackTuple = tuple[str, int, Sequence[Packable]]
@@ -33,6 +42,10 @@ class Flags(IntEnum):
     RAM = 8
     Broadcast = 16
     Required = 32
+    # Run the server handler on the worker pool instead of the main loop.
+    Deferred = 64
+    # Numeric arguments of buffered snapshot updates are interpolated on the client.
+    Interpolate = 128
 
 
 class MsgRegistry:
@@ -41,13 +54,119 @@ class MsgRegistry:
     ServerIndex: dict[int, Type[NetworkNode]] = {}
     ClientTypeIndex: dict[Type[NetworkNode], int] = {}
     ServerTypeIndex: dict[Type[NetworkNode], int] = {}
+    Signature: bytes | None = None
+    # Older schemas the server can still talk to, configured within legacy_schema(version)
+    SchemaVersion: int = 0
+    LegacyTypeIndex: dict[int, dict[int, SClassDef]] = {}
+    LegacySignatures: dict[int, bytes] = {}
+    # Per legacy version, the upgrade and downgrade hooks of the messages whose arguments changed since then
+    LegacyConverters: dict[int, dict[tuple[int, str], tuple[Callable | None, Callable | None]]] = {}
+    LegacyVersion: int | None = None
 
     @staticmethod
-    def get_signature() -> str:
-        return '\n'.join(f'{k}: {v.get_signature()}' for k, v in MsgRegistry.TypeIndex.items())
+    def get_signature(type_index: dict[int, SClassDef] = None) -> str:
+        type_index = MsgRegistry.TypeIndex if type_index is None else type_index
+        return '\n'.join(f'{k}: {v.get_signature()}' for k, v in type_index.items())
 
     @staticmethod
-    def configure(class_num: int, callbacks: Sequence[Callback], extends: list[int] = None) -> None:
+    def set_schema_version(version: int) -> None:
+        MsgRegistry.SchemaVersion = version
+
+    @staticmethod
+    @contextmanager
+    def legacy_schema(version: int) -> Iterator[None]:
+        # configure calls within this block describe the schema of an older client version
+        if version >= MsgRegistry.SchemaVersion:
+            raise ValueError(f'Legacy schema version {version} is not older than {MsgRegistry.SchemaVersion}')
+
+        current = MsgRegistry.TypeIndex
+        MsgRegistry.TypeIndex = MsgRegistry.LegacyTypeIndex.setdefault(version, {})
+        MsgRegistry.LegacyVersion = version
+        try:
+            yield
+        finally:
+            MsgRegistry.TypeIndex = current
+            MsgRegistry.LegacyVersion = None
+
+    @staticmethod
+    def convert(class_num: int, message_type: str, upgrade: Callable[..., tuple[...]] = None,
+                downgrade: Callable[..., tuple[...]] = None) -> None:
+        # Called within legacy_schema(version) for messages whose arguments changed since that version: upgrade
+        # takes the arguments of the legacy message and returns the current ones, downgrade does the opposite.
+        # Changed messages without the matching hook are dropped instead of being delivered with the wrong layout.
+        if MsgRegistry.LegacyVersion is None:
+            raise RuntimeError('convert must be called within legacy_schema')
+        converters = MsgRegistry.LegacyConverters.setdefault(MsgRegistry.LegacyVersion, {})
+        converters[class_num, message_type] = upgrade, downgrade
+
+    @staticmethod
+    def get_converters(version: int) -> dict[tuple[int, str], tuple[Callable | None, Callable | None]]:
+        return MsgRegistry.LegacyConverters.get(version, {})
+
+    @staticmethod
+    def get_type_index(version: int) -> dict[int, SClassDef] | None:
+        if version == MsgRegistry.SchemaVersion:
+            return MsgRegistry.TypeIndex
+        return MsgRegistry.LegacyTypeIndex.get(version)
+
+    @staticmethod
+    def get_version_signature(version: int) -> bytes | None:
+        if version == MsgRegistry.SchemaVersion:
+            return MsgRegistry.Signature
+        return MsgRegistry.LegacySignatures.get(version)
+
+    @staticmethod
+    def is_frozen() -> bool:
+        return MsgRegistry.Signature is not None
+
+    @staticmethod
+    def validate() -> None:
+        for class_num, stype in [item for index in (MsgRegistry.TypeIndex, *MsgRegistry.LegacyTypeIndex.values())
+                                 for item in index.items()]:
+            if class_num in SpecialMessage.__members__.values():
+                raise ValueError(f'Class number {class_num} collides with a special message')
+            if class_num == 0xFFFF:
+                raise ValueError('Class number 65535 is reserved for the RAM journal')
+            if len(stype.message_numbers) != len(stype.conf_index):
+                raise ValueError(f'Class {class_num} defines a message more than once')
+            if len(stype.conf_index) > 0xFFFF:
+                raise ValueError(f'Class {class_num} has too many messages')
+
+        for side, index in (('Server', MsgRegistry.ServerIndex), ('Client', MsgRegistry.ClientIndex)):
+            for class_num, cls in index.items():
+                if class_num not in MsgRegistry.TypeIndex:
+                    raise ValueError(f'{side} class {cls.__name__} uses class number {class_num}, '
+                                     f'which was never configured')
+
+    @staticmethod
+    def compute_signature(type_index: dict[int, SClassDef] = None) -> bytes:
+        h = hashlib.new('sha256')
+        h.update(MsgRegistry.get_signature(type_index).encode('utf-8'))
+        return h.digest()
+
+    @staticmethod
+    def freeze() -> None:
+        # Validates the schema and compiles the lookup tables and the signature once; configure is not allowed
+        # afterwards
+        if MsgRegistry.is_frozen():
+            return
+
+        MsgRegistry.validate()
+        for stype in MsgRegistry.TypeIndex.values():
+            stype.freeze()
+        for version, type_index in MsgRegistry.LegacyTypeIndex.items():
+            for stype in type_index.values():
+                stype.freeze()
+            MsgRegistry.LegacySignatures[version] = MsgRegistry.compute_signature(type_index)
+        MsgRegistry.Signature = MsgRegistry.compute_signature()
+
+    @staticmethod
+    def configure(class_num: int, callbacks: Sequence[Callback], extends: list[int] = None,
+                  rate_limits: dict[str, RateLimit] = None) -> None:
+        # rate_limits maps message names, including inherited ones, to the rate clients may send them at
+        if MsgRegistry.is_frozen():
+            raise RuntimeError('The message registry is frozen, configure must be called before launch or connect')
+
         if class_num not in MsgRegistry.TypeIndex:
             MsgRegistry.TypeIndex[class_num] = SClassDef()
 
@@ -62,6 +181,16 @@ class MsgRegistry:
             extends_types = [MsgRegistry.TypeIndex[extend] for extend in extends]
             callback_cfg = [(mt, c) for ptype in extends_types for mt, n, c in ptype.conf_index] + callback_cfg
 
+        if rate_limits:
+            unknown = set(rate_limits).difference(mt for mt, c in callback_cfg)
+            if unknown:
+                raise ValueError(f'Rate limits for unknown messages of class {class_num}: {", ".join(sorted(unknown))}')
+            # Inherited configurations are shared with the parent class, so they are copied
+            callback_cfg = [(mt, CallbackConfig(c.flags, c.arg_types, default_value=c.default,
+                                                rate_limit=rate_limits[mt], returns=c.return_types))
+                            if mt in rate_limits else (mt, c)
+                            for mt, c in callback_cfg]
+
         stype = MsgRegistry.TypeIndex[class_num]
         for message_number, (message_type, callback) in enumerate(callback_cfg):
             stype.add_message(message_type, message_number, callback)
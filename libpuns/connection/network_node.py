@@ -4,6 +4,7 @@ from direct.distributed.PyDatagram import PyDatagram
 from direct.showbase.DirectObject import DirectObject
 
 from libpuns.connection.datagram_util import ObjectID, add_object_id, SClassDef
+from libpuns.connection.rpc import RpcFuture
 
 
 class DirectorProto(Protocol):
@@ -14,6 +15,9 @@ class DirectorProto(Protocol):
     def send_datagram_to(self, obj: Union[ObjectID, 'NetworkNode'], flags: int, datagram: PyDatagram, **kwargs) -> None:
         ...
 
+    def send_rpc(self, obj: 'NetworkNode', message_type: str, args: tuple[...], **kwargs) -> RpcFuture:
+        ...
+
 
 class NetworkNode(DirectObject):
     ClassNumber: int = None
@@ -35,3 +39,8 @@ class NetworkNode(DirectObject):
         add_object_id(dg, self.oid)
         dg = cdef.compile_datagram(message_type, *args, init_datagram=dg)
         self.director.send_datagram_to(self, cdef.get_flags(message_type), dg, **kwargs)
+
+    def call(self, message_type: str, *args, **kwargs) -> RpcFuture:
+        # Calls do_{message_type} on the other side and resolves the future with what it returned. Calls made
+        # during a frame are sent together at its end.
+        return self.director.send_rpc(self, message_type, args, **kwargs)
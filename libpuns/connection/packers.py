@@ -15,6 +15,14 @@ class Int32(Packable):
         return pdi.getInt32()
 
 
+class Float32(Packable):
+    def pack(self, message: PyDatagram, item: float) -> None:
+        message.addFloat32(item)
+
+    def unpack(self, pdi: PyDatagramIterator) -> float:
+        return pdi.getFloat32()
+
+
 class String(Packable):
     def pack(self, message: PyDatagram, item: str) -> None:
         message.addString(item)
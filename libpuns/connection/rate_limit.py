@@ -0,0 +1,52 @@
+from collections import deque
+from enum import IntEnum, auto
+
+
+class RatePolicy(IntEnum):
+    # Messages over the limit are discarded
+    Drop = auto()
+    # Messages over the limit are queued and handled in order once tokens are available, up to burst of them
+    Throttle = auto()
+    # The client is kicked on the first message over the limit
+    Kick = auto()
+
+
+class RateLimit:
+    # Allows rate messages per second on average, and bursts of up to burst messages
+    def __init__(self, rate: float, burst: float = None, policy: RatePolicy = RatePolicy.Drop):
+        if rate <= 0:
+            raise ValueError(f'Invalid rate limit of {rate} messages per second')
+
+        self.rate = rate
+        self.burst = max(rate, 1) if burst is None else burst
+        self.policy = policy
+
+    def __repr__(self) -> str:
+        return f'RateLimit({self.rate}, {self.burst}, {self.policy.name})'
+
+
+class TokenBucket:
+    __slots__ = 'limit', 'tokens', 'updated', 'pending'
+
+    def __init__(self, limit: RateLimit, now: float):
+        self.limit = limit
+        self.tokens = limit.burst
+        self.updated = now
+        # Throttled messages waiting for tokens
+        self.pending = deque()
+
+    def take(self, now: float) -> bool:
+        self.tokens = min(self.limit.burst, self.tokens + (now - self.updated) * self.limit.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def defer(self, message) -> bool:
+        # Returns False if the queue is full, and the message must be dropped
+        if len(self.pending) >= self.limit.burst:
+            return False
+
+        self.pending.append(message)
+        return True
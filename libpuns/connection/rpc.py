@@ -0,0 +1,236 @@
+import queue
+from concurrent.futures import Future
+from enum import IntEnum, auto
+from typing import Callable, Hashable, Iterator
+
+from direct.directnotify.DirectNotifyGlobal import directNotify
+from direct.distributed.PyDatagram import PyDatagram
+from direct.distributed.PyDatagramIterator import PyDatagramIterator
+from panda3d.core import Datagram
+
+from libpuns.connection.connection_globals import SpecialMessage
+from libpuns.connection.datagram_util import CallbackConfig, ObjectID, add_object_id, extract_object_id
+from libpuns.connection.timer_wheel import TimerWheel
+
+
+class RpcStatus(IntEnum):
+    Ok = auto()
+    # The handler failed, the payload is the message of the RpcError it raised
+    Error = auto()
+    # The object is unknown, or the message is not a remote call
+    Rejected = auto()
+    RateLimited = auto()
+
+
+class RpcError(Exception):
+    # Raised by handlers to fail the call with a message for the caller, and set on the caller's future
+    def __init__(self, message: str, status: RpcStatus = RpcStatus.Error):
+        super().__init__(message)
+        self.status = status
+
+
+class RpcFuture(Future):
+    # Can also be awaited from Panda3D coroutine tasks, which check it once per frame
+    def __await__(self):
+        while not self.done():
+            yield
+        return self.result()
+
+
+class PendingCall:
+    __slots__ = 'future', 'destination', 'cfg', 'name'
+
+    def __init__(self, future: RpcFuture, destination: Hashable, cfg: CallbackConfig, name: str):
+        self.future = future
+        self.destination = destination
+        self.cfg = cfg
+        self.name = name
+
+    def resolve(self, value) -> None:
+        # The caller may have cancelled the future in the meantime
+        if not self.future.cancelled():
+            self.future.set_result(value)
+
+    def fail(self, error: Exception) -> None:
+        if not self.future.cancelled():
+            self.future.set_exception(error)
+
+
+RemoteCall = tuple[int, int, ObjectID, int, bytes]
+
+
+class RpcManager:
+    # Remote calls of a director. Outgoing calls and responses are queued per destination (a connection) and
+    # sent batched once per frame by flush. Calls that are not answered within their timeout fail with
+    # TimeoutError. Handlers returning a Future are answered when it completes, from any thread.
+    calls: dict[int, PendingCall]
+    requests: dict[Hashable, list[bytes]]
+    responses: dict[Hashable, list[bytes]]
+    notify = directNotify.newCategory('RpcManager')
+
+    MaxEntrySize = 0xFFFF
+
+    def __init__(self, timeout: float = 10, max_datagram_size: int = 60000):
+        self.timeout = timeout
+        self.max_datagram_size = max_datagram_size
+        self.calls = {}
+        self.next_call_id = 1
+        self.timers = TimerWheel()
+        self.requests = {}
+        self.responses = {}
+        self.completed = queue.SimpleQueue()
+        # Called when a result completes later, to wake up a main loop waiting for the sockets
+        self.on_complete: Callable[[], None] | None = None
+
+    def call(self, destination: Hashable, class_number: int, oid: ObjectID, message_number: int, name: str,
+             cfg: CallbackConfig, args: tuple[...], timeout: float = None, future: RpcFuture = None) -> RpcFuture:
+        future = future or RpcFuture()
+        arguments = PyDatagram()
+        cfg.pack(arguments, args)
+        if arguments.getLength() > self.MaxEntrySize:
+            future.set_exception(ValueError(f'The arguments of {name} are too large'))
+            return future
+
+        call_id = self.next_call_id
+        self.next_call_id = self.next_call_id % 0xFFFFFFFF + 1
+        entry = PyDatagram()
+        entry.addUint32(call_id)
+        entry.addUint16(class_number)
+        add_object_id(entry, oid)
+        entry.addUint16(message_number)
+        entry.addUint16(arguments.getLength())
+        entry.appendData(arguments.getMessage())
+
+        self.calls[call_id] = PendingCall(future, destination, cfg, name)
+        self.timers.schedule(call_id, self.timeout if timeout is None else timeout)
+        self.requests.setdefault(destination, []).append(entry.getMessage())
+        return future
+
+    @staticmethod
+    def read_requests(pdi: PyDatagramIterator) -> Iterator[RemoteCall]:
+        for i in range(pdi.getUint16()):
+            call_id = pdi.getUint32()
+            class_number = pdi.getUint16()
+            oid = extract_object_id(pdi)
+            message_number = pdi.getUint16()
+            yield call_id, class_number, oid, message_number, pdi.extractBytes(pdi.getUint16())
+
+    @staticmethod
+    def unpack_args(cfg: CallbackConfig, data: bytes) -> tuple[...]:
+        datagram = Datagram(data)
+        return cfg.unpack(PyDatagramIterator(datagram))
+
+    def respond(self, destination: Hashable, call_id: int, status: RpcStatus, payload: bytes) -> None:
+        if len(payload) > self.MaxEntrySize:
+            self.notify.warning(f'Response to call {call_id} is too large')
+            status, payload = RpcStatus.Error, self.encode_error('Response too large')
+
+        entry = PyDatagram()
+        entry.addUint32(call_id)
+        entry.addUint8(status)
+        entry.addUint16(len(payload))
+        entry.appendData(payload)
+        self.responses.setdefault(destination, []).append(entry.getMessage())
+
+    def reject(self, destination: Hashable, call_id: int, status: RpcStatus, message: str) -> None:
+        self.respond(destination, call_id, status, self.encode_error(message))
+
+    @staticmethod
+    def encode_error(message: str) -> bytes:
+        dg = PyDatagram()
+        dg.addString(message)
+        return dg.getMessage()
+
+    def complete(self, destination: Hashable, call_id: int, cfg: CallbackConfig, result: Future) -> None:
+        # Answers the call once result is done, handlers may complete it later or from another thread
+        if result.done():
+            self.send_result(destination, call_id, cfg, result)
+        else:
+            result.add_done_callback(lambda f: self.queue_result(destination, call_id, cfg, f))
+
+    def queue_result(self, destination: Hashable, call_id: int, cfg: CallbackConfig, result: Future) -> None:
+        # May run on any thread, the result is sent by the next flush
+        self.completed.put((destination, call_id, cfg, result))
+        if self.on_complete is not None:
+            self.on_complete()
+
+    def send_result(self, destination: Hashable, call_id: int, cfg: CallbackConfig, result: Future) -> None:
+        error = result.exception()
+        if error is None and isinstance(result.result(), Future):
+            self.complete(destination, call_id, cfg, result.result())
+            return
+
+        if error is None:
+            dg = PyDatagram()
+            cfg.pack_returns(dg, result.result())
+            self.respond(destination, call_id, RpcStatus.Ok, dg.getMessage())
+        elif isinstance(error, RpcError):
+            self.reject(destination, call_id, error.status, str(error))
+        else:
+            # Only the errors meant for the caller are sent, the others could leak server internals
+            self.notify.warning(f'Remote call {call_id} failed: {error!r}')
+            self.reject(destination, call_id, RpcStatus.Error, 'Internal error')
+
+    def handle_responses(self, source: Hashable, pdi: PyDatagramIterator) -> None:
+        for i in range(pdi.getUint16()):
+            call_id = pdi.getUint32()
+            status = pdi.getUint8()
+            datagram = Datagram(pdi.extractBytes(pdi.getUint16()))
+            call = self.calls.get(call_id)
+            if call is None:
+                # Timed out already
+                continue
+            if call.destination != source:
+                # Call IDs are sequential, only the connection that was called may answer
+                self.notify.warning(f'Dropped the response to call {call_id} from a connection it was not sent to')
+                continue
+
+            del self.calls[call_id]
+            self.timers.cancel(call_id)
+            payload = PyDatagramIterator(datagram)
+            if status == RpcStatus.Ok:
+                call.resolve(call.cfg.unpack_returns(payload))
+            else:
+                status = RpcStatus(status) if status in RpcStatus.__members__.values() else RpcStatus.Error
+                call.fail(RpcError(f'{call.name}: {payload.getString()}', status))
+
+    def expire(self, now: float = None) -> None:
+        for call_id in self.timers.advance(now):
+            call = self.calls.pop(call_id)
+            call.fail(TimeoutError(f'Remote call {call.name} timed out'))
+
+    def fail_destination(self, destination: Hashable) -> None:
+        # The connection is gone: its pending calls fail and nothing is sent to it anymore
+        self.requests.pop(destination, None)
+        self.responses.pop(destination, None)
+        for call_id, call in list(self.calls.items()):
+            if call.destination == destination:
+                del self.calls[call_id]
+                self.timers.cancel(call_id)
+                call.fail(ConnectionError(f'Remote call {call.name} was not answered'))
+
+    def flush(self, send: Callable[[Hashable, PyDatagram], None]) -> None:
+        while not self.completed.empty():
+            self.send_result(*self.completed.get())
+
+        for message_type, queued in ((SpecialMessage.RpcRequest, self.requests),
+                                     (SpecialMessage.RpcResponse, self.responses)):
+            for destination, entries in queued.items():
+                body = count = None
+                for entry in entries:
+                    if body is None or body.getLength() + len(entry) > self.max_datagram_size or count == 0xFFFF:
+                        if body is not None:
+                            send(destination, self.make_batch(message_type, body, count))
+                        body, count = PyDatagram(), 0
+                    body.appendData(entry)
+                    count += 1
+                send(destination, self.make_batch(message_type, body, count))
+            queued.clear()
+
+    @staticmethod
+    def make_batch(message_type: SpecialMessage, entries: PyDatagram, count: int) -> PyDatagram:
+        dg = PyDatagram()
+        dg.addUint16(message_type)
+        dg.addUint16(count)
+        dg.appendData(entries.getMessage())
+        return dg
@@ -0,0 +1,132 @@
+from typing import Callable
+
+from direct.distributed.PyDatagram import PyDatagram
+from direct.distributed.PyDatagramIterator import PyDatagramIterator
+from panda3d.core import Datagram
+
+from libpuns.connection.connection_globals import SpecialMessage
+from libpuns.connection.datagram_util import Packable, SClassDef, add_object_id, extract_object_id
+
+
+def get_layout(packables: list[Packable] | None) -> str | None:
+    # What has to match for values to be passed as is between schemas, unlike the flags
+    if packables is None:
+        return None
+    return '|'.join(packable.get_signature() for packable in packables)
+
+
+class SchemaTranscoder:
+    # Rewrites datagrams compiled with one schema for a client using another one. Messages are matched
+    # by name; messages the target schema does not know are dropped. Arguments of messages whose layout
+    # differs are converted by the hooks passed to MsgRegistry.convert, those without hooks are dropped.
+    changes: dict[tuple[int, str], tuple[bool, bool] | None]
+
+    def __init__(self, source: dict[int, SClassDef], target: dict[int, SClassDef],
+                 converters: dict[tuple[int, str], tuple[Callable | None, Callable | None]] = None):
+        self.source = source
+        self.target = target
+        self.converters = converters or {}
+        self.changes = {}
+
+    def get_changes(self, class_number: int, msg_name: str) -> tuple[bool, bool] | None:
+        # Whether the arguments and the results of a message differ between the schemas, None if either lacks it
+        key = class_number, msg_name
+        if key not in self.changes:
+            source, target = self.source.get(class_number), self.target.get(class_number)
+            if source is None or target is None or msg_name not in source.message_numbers \
+                    or msg_name not in target.message_numbers:
+                self.changes[key] = None
+            else:
+                source_cfg = source.configurations[source.get_message_number(msg_name)]
+                target_cfg = target.configurations[target.get_message_number(msg_name)]
+                self.changes[key] = (get_layout(source_cfg.arg_types) != get_layout(target_cfg.arg_types),
+                                     get_layout(source_cfg.return_types) != get_layout(target_cfg.return_types))
+        return self.changes[key]
+
+    def convert(self, class_number: int, msg_name: str, args: tuple[...], hook: int) -> tuple[...] | None:
+        changes = self.get_changes(class_number, msg_name)
+        if changes is None or changes[1]:
+            # The hooks only convert arguments, remote calls whose results changed cannot be converted
+            return None
+        if not changes[0]:
+            return args
+
+        converter = self.converters.get((class_number, msg_name), (None, None))[hook]
+        return None if converter is None else tuple(converter(*args))
+
+    def downgrade(self, class_number: int, msg_name: str, args: tuple[...]) -> tuple[...] | None:
+        # Arguments of the source schema for the target one, None if the message cannot be sent
+        return self.convert(class_number, msg_name, args, 1)
+
+    def upgrade(self, class_number: int, msg_name: str, args: tuple[...]) -> tuple[...] | None:
+        # Arguments received from a client using the target schema for the source one, None to drop the message
+        return self.convert(class_number, msg_name, args, 0)
+
+    def transcode_message(self, class_number: int, pdi: PyDatagramIterator, dg: PyDatagram) -> bool:
+        msg_name, msg_data = self.source[class_number].decompile_datagram(pdi)
+        msg_data = self.downgrade(class_number, msg_name, msg_data)
+        if msg_data is None:
+            return False
+
+        self.target[class_number].compile_datagram(msg_name, *msg_data, init_datagram=dg)
+        return True
+
+    def transcode_update(self, pdi: PyDatagramIterator, dg: PyDatagram) -> bool:
+        class_number = pdi.getUint16()
+        oid = extract_object_id(pdi)
+        update = PyDatagram()
+        update.addUint16(class_number)
+        add_object_id(update, oid)
+        if not self.transcode_message(class_number, pdi, update):
+            return False
+
+        dg.appendData(update.getMessage())
+        return True
+
+    def transcode_objects(self, pdi: PyDatagramIterator, dg: PyDatagram) -> None:
+        object_count = pdi.getUint16()
+        dg.addUint16(object_count)
+        for i in range(object_count):
+            add_object_id(dg, extract_object_id(pdi))
+            class_number = pdi.getUint16()
+            dg.addUint16(class_number)
+            dg.addUint32(pdi.getUint32())
+
+            fields = PyDatagram()
+            field_count = 0
+            for j in range(pdi.getUint16()):
+                field_count += self.transcode_message(class_number, pdi, fields)
+            dg.addUint16(field_count)
+            dg.appendData(fields.getMessage())
+
+    def transcode(self, datagram: Datagram) -> PyDatagram | None:
+        # Returns None if nothing is left to send
+        pdi = PyDatagramIterator(datagram)
+        message_type = pdi.getUint16()
+        dg = PyDatagram()
+        if message_type not in SpecialMessage.__members__.values():
+            # Object updates start with the class number, read it again
+            pdi = PyDatagramIterator(datagram)
+            return dg if self.transcode_update(pdi, dg) else None
+
+        dg.addUint16(message_type)
+        if message_type == SpecialMessage.ObjectResponse:
+            self.transcode_objects(pdi, dg)
+        elif message_type == SpecialMessage.ZoneData:
+            dg.addUint32(pdi.getUint32())
+            member_count = pdi.getUint16()
+            dg.addUint16(member_count)
+            for i in range(member_count):
+                add_object_id(dg, extract_object_id(pdi))
+            self.transcode_objects(pdi, dg)
+        elif message_type == SpecialMessage.Snapshot:
+            dg.addUint32(pdi.getUint32())
+            entries = PyDatagram()
+            entry_count = 0
+            for i in range(pdi.getUint16()):
+                entry_count += self.transcode_update(pdi, entries)
+            dg.addUint16(entry_count)
+            dg.appendData(entries.getMessage())
+        else:
+            return datagram
+        return dg
@@ -0,0 +1,58 @@
+import math
+import time
+from typing import Hashable
+
+
+class TimerWheel:
+    # Hashed timer wheel: scheduling and cancelling are O(1), and advancing only looks at the slots
+    # that passed since the previous call. Timers firing more than a full turn away stay in their slot
+    # until their deadline comes.
+    slots: list[set[Hashable]]
+    deadlines: dict[Hashable, tuple[float, int]]
+
+    def __init__(self, resolution: float = 0.1, slot_count: int = 128):
+        self.resolution = resolution
+        self.slots = [set() for _ in range(slot_count)]
+        self.deadlines = {}
+        self.current_tick = None
+
+    def get_tick(self, moment: float) -> int:
+        return math.floor(moment / self.resolution)
+
+    def schedule(self, key: Hashable, delay: float, now: float = None) -> None:
+        now = time.monotonic() if now is None else now
+        self.cancel(key)
+        if self.current_tick is None:
+            self.current_tick = self.get_tick(now)
+
+        deadline = now + delay
+        # Round up so the timer is due whenever its slot is processed, and never use an already processed slot
+        slot = max(math.ceil(deadline / self.resolution), self.current_tick + 1) % len(self.slots)
+        self.deadlines[key] = deadline, slot
+        self.slots[slot].add(key)
+
+    def cancel(self, key: Hashable) -> None:
+        timer = self.deadlines.pop(key, None)
+        if timer is not None:
+            self.slots[timer[1]].discard(key)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.deadlines
+
+    def advance(self, now: float = None) -> list[Hashable]:
+        now = time.monotonic() if now is None else now
+        target = self.get_tick(now)
+        if self.current_tick is None or not self.deadlines:
+            self.current_tick = target
+            return []
+
+        expired = []
+        first = self.current_tick + 1
+        for tick in range(first, min(target, first + len(self.slots) - 1) + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for key in [key for key in slot if self.deadlines[key][0] <= now]:
+                slot.remove(key)
+                del self.deadlines[key]
+                expired.append(key)
+        self.current_tick = target
+        return expired
@@ -0,0 +1,90 @@
+import struct
+import time
+from enum import IntEnum, auto
+from typing import Iterator
+
+from direct.distributed.PyDatagram import PyDatagram
+from direct.distributed.PyDatagramIterator import PyDatagramIterator
+from panda3d.core import Datagram
+
+from libpuns.connection.connection_globals import SpecialMessage
+from libpuns.connection.message_registry import MsgRegistry
+
+
+class RecordKind(IntEnum):
+    # The connection was accepted, no data
+    Opened = auto()
+    # The connection was dropped by either side, no data
+    Closed = auto()
+    # A datagram received from the connection
+    Inbound = auto()
+    # A datagram sent to the connection, after transcoding and compression
+    Outbound = auto()
+
+
+class TrafficRecorder:
+    # Writes the traffic of a director to a file: a header with the schema version, then one record per
+    # event laid out as (seconds since the recorder was created, kind, connection ID, data length, data).
+    Magic = b'PUNSREC1'
+    FileHeader = struct.Struct('<8sH')
+    RecordHeader = struct.Struct('<dBII')
+
+    def __init__(self, path: str):
+        # Create it once the registry is configured, the schema version is written in the header
+        self.path = path
+        self.file = open(path, 'wb', buffering=1024 * 1024)
+        self.file.write(self.FileHeader.pack(self.Magic, MsgRegistry.SchemaVersion))
+        self.start = time.monotonic()
+        self.records_written = 0
+
+    def record(self, kind: RecordKind, connection_id: int, data: bytes = b'') -> None:
+        self.file.write(self.RecordHeader.pack(time.monotonic() - self.start, kind, connection_id, len(data)))
+        self.file.write(data)
+        self.records_written += 1
+
+    @staticmethod
+    def redact(datagram: Datagram) -> bytes:
+        # Connection requests are recorded without their token, replays log in through the database of the
+        # replayed director. A malformed request only keeps its message type, the server rejects it anyway.
+        pdi = PyDatagramIterator(datagram)
+        if datagram.getLength() < 2 or pdi.getUint16() != SpecialMessage.ConnectionRequest:
+            return datagram.getMessage()
+
+        dg = PyDatagram()
+        dg.addUint16(SpecialMessage.ConnectionRequest)
+        try:
+            signature, schema_version, capabilities = pdi.getBlob(), pdi.getUint16(), pdi.getUint32()
+            login = pdi.getString()
+            pdi.getString()
+        except AssertionError:
+            return dg.getMessage()
+
+        dg.addBlob(signature)
+        dg.addUint16(schema_version)
+        dg.addUint32(capabilities)
+        dg.addString(login)
+        dg.addString('')
+        return dg.getMessage()
+
+    def close(self) -> None:
+        if not self.file.closed:
+            self.file.close()
+
+    @classmethod
+    def read(cls, path: str) -> tuple[int, Iterator[tuple[float, RecordKind, int, bytes]]]:
+        # Returns the schema version and the records, a truncated last record is ignored
+        f = open(path, 'rb')
+        magic, schema_version = cls.FileHeader.unpack(f.read(cls.FileHeader.size))
+        if magic != cls.Magic:
+            f.close()
+            raise ValueError(f'{path} is not a libpuns traffic recording')
+
+        def records():
+            with f:
+                while len(header := f.read(cls.RecordHeader.size)) == cls.RecordHeader.size:
+                    timestamp, kind, connection_id, length = cls.RecordHeader.unpack(header)
+                    data = f.read(length)
+                    if len(data) != length:
+                        break
+                    yield timestamp, RecordKind(kind), connection_id, data
+        return schema_version, records()
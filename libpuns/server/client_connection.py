@@ -0,0 +1,57 @@
+from enum import IntEnum, auto
+
+from panda3d.core import PointerToConnection
+
+from libpuns.connection.datagram_util import ObjectID
+from libpuns.connection.message_registry import MsgRegistry
+from libpuns.connection.rate_limit import RateLimit, TokenBucket
+
+
+class ConnectionState(IntEnum):
+    # Accepted by the listener, waiting for the ConnectionRequest
+    Partial = auto()
+    # Logged in and owning its player object
+    Identified = auto()
+    # Dropped, the entry is only kept alive by stale references
+    Closed = auto()
+
+
+class ClientConnection:
+    # Everything the server tracks about one connection. Timestamps use time.monotonic().
+    def __init__(self, connection: PointerToConnection, connection_id: int, now: float):
+        self.connection = connection
+        self.connection_id = connection_id
+        self.state = ConnectionState.Partial
+        self.connected_at = now
+        self.identified_at = None
+        self.last_seen = now
+        self.round_trip_time = None
+        self.oid: ObjectID | None = None
+        self.schema_version = MsgRegistry.SchemaVersion
+        self.capabilities = 0
+        # Token buckets of the connection rate limit and of the message rate limits, created on first use
+        self.rate_bucket: TokenBucket | None = None
+        self.message_buckets: dict[tuple[int, str], TokenBucket] = {}
+        self.rate_limited = 0
+
+    def identify(self, oid: ObjectID, schema_version: int, capabilities: int, now: float) -> None:
+        self.state = ConnectionState.Identified
+        self.identified_at = now
+        self.oid = oid
+        self.schema_version = schema_version
+        self.capabilities = capabilities
+
+    def get_message_bucket(self, class_number: int, message_name: str, limit: RateLimit, now: float) -> TokenBucket:
+        bucket = self.message_buckets.get((class_number, message_name))
+        if bucket is None:
+            bucket = self.message_buckets[class_number, message_name] = TokenBucket(limit, now)
+        return bucket
+
+    def get_buckets(self) -> list[TokenBucket]:
+        buckets = list(self.message_buckets.values())
+        if self.rate_bucket is not None:
+            buckets.append(self.rate_bucket)
+        return buckets
+
+    def close(self) -> None:
+        self.state = ConnectionState.Closed
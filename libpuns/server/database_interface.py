@@ -1,8 +1,12 @@
 import abc
+from typing import Iterable
 
 from libpuns.connection.datagram_util import ObjectID
 
 
+ObjectData = dict[str, tuple[...]]
+
+
 class DatabaseInterface(abc.ABC):
     @abc.abstractmethod
     def attempt_login(self, login: str, token: str) -> ObjectID | None:
@@ -12,6 +16,36 @@ class DatabaseInterface(abc.ABC):
     def update_object(self, oid: ObjectID, field: str, value):
         ...
 
+    def load_object(self, oid: ObjectID) -> ObjectData | None:
+        return None
+
+    def load_objects(self, oids: Iterable[ObjectID]) -> dict[ObjectID, ObjectData]:
+        # Backends should override this with a single query
+        objects = {}
+        for oid in oids:
+            data = self.load_object(oid)
+            if data is not None:
+                objects[oid] = data
+        return objects
+
+    def set_object_zone(self, oid: ObjectID, zone: int) -> None:
+        pass
+
+    def load_zone(self, zone: int) -> dict[ObjectID, ObjectData]:
+        return {}
+
+
+# Snapshots and zone states are optional: backends supporting them implement save_snapshot(memory) and
+# load_snapshot(), or save_zone_state(zone, data) and load_zone_state(zone), which returns the saved state and
+# deletes it. Zone state support is checked when the server is built with zone eviction, snapshot support only
+# when a snapshot is saved or loaded, which raises ValueError without it.
+def supports_snapshots(store) -> bool:
+    return hasattr(store, 'save_snapshot') and hasattr(store, 'load_snapshot')
+
+
+def supports_zone_state(store) -> bool:
+    return hasattr(store, 'save_zone_state') and hasattr(store, 'load_zone_state')
+
 
 class DummyDatabaseInterface(DatabaseInterface):
     def attempt_login(self, login: str, token: str) -> ObjectID | None:
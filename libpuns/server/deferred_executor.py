@@ -0,0 +1,109 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+from direct.directnotify.DirectNotifyGlobal import directNotify
+
+from libpuns.connection.datagram_util import ObjectID
+
+
+# (message name, handler, arguments, whether it runs on a worker)
+DeferredCall = tuple[str, Callable[..., None], tuple[...], bool]
+CapturedSend = tuple[Callable[..., None], tuple[...], dict[str, Any]]
+
+
+class DeferredExecutor:
+    # Runs Flags.Deferred handlers on a thread pool. Handlers of one object run one at a time in arrival order,
+    # and everything they send is replayed on the main loop when the handler completes. Messages of an object
+    # with deferred handlers pending are queued behind them, even if they run on the main loop. Deferred
+    # handlers run while the main loop changes the objects and the RAM state, so they must only use their
+    # arguments: everything else goes through capture, which replays it on the main loop.
+    pending: dict[ObjectID, deque[DeferredCall]]
+    notify = directNotify.newCategory('DeferredExecutor')
+
+    def __init__(self, max_workers: int = 4):
+        self.pool = ThreadPoolExecutor(max_workers, thread_name_prefix='libpuns-deferred')
+        self.pending = {}
+        self.completed = queue.SimpleQueue()
+        self.local = threading.local()
+        # Called from the worker threads when a handler completes, to wake up a main loop waiting for the sockets
+        self.on_complete: Callable[[], None] | None = None
+
+    def submit(self, oid: ObjectID, msg_name: str, handler: Callable[..., None], args: tuple[...]) -> None:
+        calls = self.pending.setdefault(oid, deque())
+        calls.append((msg_name, handler, args, True))
+        if len(calls) == 1:
+            self.start_next(oid)
+
+    def queue_behind(self, oid: ObjectID, msg_name: str, handler: Callable[..., None], args: tuple[...]) -> bool:
+        # Queues a main loop handler behind the deferred handlers of the object. Returns False if there are
+        # none, and the handler can run right away.
+        calls = self.pending.get(oid)
+        if not calls:
+            return False
+
+        calls.append((msg_name, handler, args, False))
+        return True
+
+    def start_next(self, oid: ObjectID) -> None:
+        calls = self.pending[oid]
+        while calls and not calls[0][3]:
+            _, handler, args, _ = calls.popleft()
+            try:
+                handler(*args)
+            except Exception:
+                # Raised like the errors of handlers that were not queued, once the rest of the queue is started
+                self.start_next(oid)
+                raise
+        if not calls:
+            del self.pending[oid]
+            return
+
+        _, handler, args, _ = calls[0]
+        future = self.pool.submit(self.run_handler, handler, args)
+        future.add_done_callback(lambda f: self.complete(oid, f))
+
+    def complete(self, oid: ObjectID, future: Future) -> None:
+        self.completed.put((oid, future))
+        if self.on_complete is not None:
+            self.on_complete()
+
+    def run_handler(self, handler: Callable[..., None], args: tuple[...]) -> tuple[list[CapturedSend], Exception | None]:
+        outbox = []
+        self.local.outbox = outbox
+        try:
+            handler(*args)
+        except Exception as e:
+            return outbox, e
+        finally:
+            self.local.outbox = None
+        return outbox, None
+
+    def capture(self, send: Callable[..., None], *args, **kwargs) -> bool:
+        # Returns True if we are inside a deferred handler and the send was queued for the main loop
+        outbox = getattr(self.local, 'outbox', None)
+        if outbox is None:
+            return False
+
+        outbox.append((send, args, kwargs))
+        return True
+
+    def poll(self) -> None:
+        while not self.completed.empty():
+            oid, future = self.completed.get()
+            self.finish(oid, future)
+
+    def finish(self, oid: ObjectID, future: Future) -> None:
+        calls = self.pending[oid]
+        msg_name, _, _, _ = calls.popleft()
+        outbox, error = future.result()
+        if error is not None:
+            self.notify.warning(f'Deferred handler do_{msg_name} of object {oid} failed: {error!r}')
+
+        try:
+            for send, args, kwargs in outbox:
+                send(*args, **kwargs)
+        finally:
+            self.start_next(oid)
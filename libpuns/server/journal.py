@@ -0,0 +1,151 @@
+import mmap
+import os
+import struct
+import time
+import zlib
+from typing import Callable, Iterable, Iterator
+
+from direct.directnotify.DirectNotifyGlobal import directNotify
+
+
+class Journal:
+    # Append-only log of RAM updates plus periodic snapshots, both stored as records in the wire encoding
+    # (class, ObjectID, message number, arguments). Each record is prefixed by its length and CRC32, so a
+    # write torn by a crash is detected and dropped. Both files start with the generation number: every
+    # snapshot bumps it, and a journal older than the snapshot is already included in it.
+    notify = directNotify.newCategory('Journal')
+
+    Magic = b'PUNSJRN1'
+    FileHeader = struct.Struct('<8sQ')
+    RecordHeader = struct.Struct('<II')
+
+    def __init__(self, directory: str, snapshot_interval: float = 300, sync_interval: float = 1):
+        self.directory = directory
+        self.journal_path = os.path.join(directory, 'journal.bin')
+        self.snapshot_path = os.path.join(directory, 'snapshot.bin')
+        self.snapshot_interval = snapshot_interval
+        self.sync_interval = sync_interval
+        self.generation = 0
+        self.file = None
+        # Records appended before recover opened the journal, they are newer than everything recovered
+        self.pending: list[bytes] = []
+        self.next_snapshot = self.next_sync = 0.0
+        self.records_written = 0
+
+    @classmethod
+    def read_records(cls, data: bytes | mmap.mmap, offset: int) -> Iterator[tuple[bytes, int]]:
+        # Yields the records with the offset after each of them, stops at the first broken record
+        view = memoryview(data)
+        while offset + cls.RecordHeader.size <= len(data):
+            length, crc = cls.RecordHeader.unpack_from(data, offset)
+            start = offset + cls.RecordHeader.size
+            record = bytes(view[start:start + length])
+            if len(record) != length or zlib.crc32(record) != crc:
+                break
+            offset = start + length
+            yield record, offset
+        view.release()
+
+    @classmethod
+    def read_file(cls, path: str) -> tuple[int, list[bytes], int]:
+        # Returns the generation, the valid records and the size of the valid part of the file
+        if not os.path.exists(path) or os.path.getsize(path) < cls.FileHeader.size:
+            return -1, [], 0
+
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, generation = cls.FileHeader.unpack_from(data, 0)
+            if magic != cls.Magic:
+                raise ValueError(f'{path} is not a libpuns journal')
+
+            records, end = [], cls.FileHeader.size
+            for record, end in cls.read_records(data, end):
+                records.append(record)
+        return generation, records, end
+
+    def recover(self) -> Iterator[bytes]:
+        # Yields the snapshot records followed by the journal records written after it, then opens the journal
+        # and writes the pending records to it, which are yielded last
+        os.makedirs(self.directory, exist_ok=True)
+        snapshot_generation, snapshot, _ = self.read_file(self.snapshot_path)
+        journal_generation, journal, journal_end = self.read_file(self.journal_path)
+        self.generation = max(snapshot_generation, journal_generation, 0)
+
+        yield from snapshot
+        if journal_generation == self.generation:
+            yield from journal
+            self.notify.info(f'Recovered {len(snapshot)} snapshot and {len(journal)} journal records')
+            self.file = open(self.journal_path, 'r+b')
+            # Anything past the last valid record is a torn write
+            self.file.truncate(journal_end)
+            self.file.seek(journal_end)
+        else:
+            self.notify.info(f'Recovered {len(snapshot)} snapshot records')
+            self.start_journal()
+
+        pending, self.pending = self.pending, []
+        for record in pending:
+            self.append(record)
+        yield from pending
+
+        now = time.monotonic()
+        self.next_snapshot = now + self.snapshot_interval
+        self.next_sync = now + self.sync_interval
+
+    def start_journal(self) -> None:
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.journal_path, 'wb')
+        self.file.write(self.FileHeader.pack(self.Magic, self.generation))
+        self.sync()
+
+    def append(self, record: bytes) -> None:
+        if self.file is None:
+            self.pending.append(record)
+            return
+        self.file.write(self.RecordHeader.pack(len(record), zlib.crc32(record)))
+        self.file.write(record)
+        self.records_written += 1
+
+    def sync(self) -> None:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def write_snapshot(self, records: Iterable[bytes]) -> None:
+        generation = self.generation + 1
+        chunks = [self.FileHeader.pack(self.Magic, generation)]
+        for record in records:
+            chunks.append(self.RecordHeader.pack(len(record), zlib.crc32(record)))
+            chunks.append(record)
+
+        size = sum(len(chunk) for chunk in chunks)
+        temp_path = self.snapshot_path + '.tmp'
+        with open(temp_path, 'w+b') as f:
+            f.truncate(size)
+            with mmap.mmap(f.fileno(), size) as data:
+                offset = 0
+                for chunk in chunks:
+                    data[offset:offset + len(chunk)] = chunk
+                    offset += len(chunk)
+                data.flush()
+        os.replace(temp_path, self.snapshot_path)
+
+        # Only now the old journal is redundant
+        self.generation = generation
+        self.start_journal()
+
+    def update(self, get_records: Callable[[], Iterable[bytes]], now: float = None) -> None:
+        # Called periodically: syncs the journal every sync_interval and snapshots every snapshot_interval
+        now = time.monotonic() if now is None else now
+        if now >= self.next_snapshot:
+            self.next_snapshot = now + self.snapshot_interval
+            self.next_sync = now + self.sync_interval
+            self.write_snapshot(get_records())
+        elif now >= self.next_sync:
+            self.next_sync = now + self.sync_interval
+            self.sync()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
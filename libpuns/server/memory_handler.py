@@ -1,47 +1,332 @@
-from typing import Any
+import marshal
+import random
+from typing import Any, Iterable, Iterator
 
 from direct.distributed.PyDatagram import PyDatagram
+from direct.distributed.PyDatagramIterator import PyDatagramIterator
 
-from libpuns.connection.datagram_util import ObjectID
-from libpuns.connection.message_registry import Flags
-from libpuns.server.database_interface import DatabaseInterface
+from libpuns.connection.datagram_util import ObjectID, add_object_id, extract_object_id
+from libpuns.connection.message_registry import Flags, MsgRegistry
+from libpuns.server.database_interface import DatabaseInterface, ObjectData, supports_snapshots, supports_zone_state
+from libpuns.server.journal import Journal
 from libpuns.server.server_node import SNetworkNode
+from libpuns.server.zone_store import ZoneStore
+
+
+def encode_record(class_number: int, oid: ObjectID, field: str, value: tuple[...]) -> bytes:
+    # A record is laid out exactly like the object update datagram
+    dg = PyDatagram()
+    dg.addUint16(class_number)
+    add_object_id(dg, oid)
+    MsgRegistry.TypeIndex[class_number].compile_datagram(field, *value, init_datagram=dg)
+    return dg.getMessage()
+
+
+# Per object: class number (None if unknown), version, whether database fields were loaded, then every field
+# with its version and value
+ZoneState = dict[ObjectID, tuple[int | None, int, bool, dict[str, tuple[int, tuple[...]]]]]
+
+
+def encode_zone_state(state: ZoneState) -> bytes:
+    # Same as the SQLite backend, marshal is fast and the format version is pinned
+    return marshal.dumps(state, 4)
+
+
+def decode_zone_state(data: bytes) -> ZoneState:
+    return marshal.loads(data)
+
+
+# Class number of the records marking an object as forgotten, no message follows the ObjectID
+DeletedObject = 0xFFFF
+
+
+def encode_deletion(oid: ObjectID) -> bytes:
+    dg = PyDatagram()
+    dg.addUint16(DeletedObject)
+    add_object_id(dg, oid)
+    return dg.getMessage()
+
+
+def decode_record(record: bytes) -> tuple[int, ObjectID, str | None, tuple[...] | None]:
+    # The iterator does not keep the datagram alive
+    dg = PyDatagram(record)
+    pdi = PyDatagramIterator(dg)
+    class_number = pdi.getUint16()
+    oid = extract_object_id(pdi)
+    if class_number == DeletedObject:
+        return class_number, oid, None, None
+    field, value = MsgRegistry.TypeIndex[class_number].decompile_datagram(pdi)
+    return class_number, oid, field, value
 
 
 class MemoryHandler:
     query_memory: dict[ObjectID, dict[str, Any]]
+    # Every set_data bumps the object version; field versions store the object version of their last change.
+    # Versions come from a single counter, so an object created again never reuses the versions of the previous
+    # one, and the epoch changes with every run as the client caches may hold versions of a previous run.
+    epoch: int
+    version_counter: int
+    versions: dict[ObjectID, int]
+    field_versions: dict[ObjectID, dict[str, int]]
+    # Database objects whose stored fields were already loaded into memory (or found missing)
+    hydrated: set[ObjectID]
+    object_classes: dict[ObjectID, int]
+    # The zone owning every object placed in one, objects of idle zones are evicted together
+    zone_objects: dict[int, set[ObjectID]]
+    object_zones: dict[ObjectID, int]
+    # Evicted objects and their zone, accessing one of them loads the whole zone back
+    evicted: dict[ObjectID, int]
 
-    def __init__(self, db_interface: DatabaseInterface):
+    def __init__(self, db_interface: DatabaseInterface, journal: Journal = None,
+                 zone_store: DatabaseInterface | ZoneStore = None, zone_eviction: bool = False):
         self.db_interface = db_interface
+        self.journal = journal
+        self.snapshots = supports_snapshots(db_interface)
+        # Zones evicted by a previous run are loaded back whenever the store keeps zone states
+        self.zone_store = zone_store or db_interface
+        self.zone_states = supports_zone_state(self.zone_store)
+        if zone_eviction and not self.zone_states:
+            raise ValueError(f'{self.zone_store.__class__.__name__} cannot store evicted zones, pass a zone_store')
+        self.epoch = random.getrandbits(32)
+        self.version_counter = 0
         self.query_memory = {}
+        self.versions = {}
+        self.field_versions = {}
+        self.hydrated = set()
+        self.object_classes = {}
+        self.zone_objects = {}
+        self.object_zones = {}
+        self.evicted = {}
+
+    @staticmethod
+    def is_database_object(oid: ObjectID) -> bool:
+        # Dynamic objects use int32 ObjectIDs and are never stored in the database
+        return not isinstance(oid, int)
+
+    def load_fields(self, oid: ObjectID, fields: ObjectData, overwrite: bool = False) -> None:
+        # Unless overwriting, loaded fields do not override whatever was set in memory in the meantime
+        memory = self.query_memory.setdefault(oid, {})
+        field_versions = self.field_versions.setdefault(oid, {})
+        for field, value in fields.items():
+            if overwrite or field not in memory:
+                version = self.next_version()
+                self.versions[oid] = version
+                memory[field] = value
+                field_versions[field] = version
+
+    def next_version(self) -> int:
+        self.version_counter += 1
+        return self.version_counter
+
+    def hydrate(self, oid: ObjectID) -> None:
+        if oid in self.evicted:
+            self.load_zone(self.evicted[oid])
+        if oid in self.hydrated or not self.is_database_object(oid):
+            return
+
+        self.hydrated.add(oid)
+        fields = self.db_interface.load_object(oid)
+        if fields:
+            self.load_fields(oid, fields)
+
+    def prefetch_zone(self, zone: int) -> None:
+        for oid, fields in self.db_interface.load_zone(zone).items():
+            if oid not in self.object_zones:
+                self.assign_zone(oid, zone)
+            if oid not in self.hydrated:
+                self.hydrated.add(oid)
+                self.load_fields(oid, fields)
+
+    def assign_zone(self, oid: ObjectID, zone: int) -> None:
+        previous = self.object_zones.get(oid)
+        if previous == zone:
+            return
+
+        if previous is not None:
+            self.zone_objects[previous].discard(oid)
+            if not self.zone_objects[previous]:
+                del self.zone_objects[previous]
+        self.object_zones[oid] = zone
+        self.zone_objects.setdefault(zone, set()).add(oid)
+
+    def set_object_zone(self, oid: ObjectID, zone: int) -> None:
+        self.assign_zone(oid, zone)
+        if self.is_database_object(oid):
+            self.db_interface.set_object_zone(oid, zone)
+
+    def export_objects(self, oids: Iterable[ObjectID]) -> ZoneState:
+        state = {}
+        for oid in oids:
+            memory = self.query_memory.get(oid, {})
+            field_versions = self.field_versions.get(oid, {})
+            fields = {field: (field_versions.get(field, 0), value) for field, value in memory.items()}
+            state[oid] = self.object_classes.get(oid), self.versions.get(oid, 0), oid in self.hydrated, fields
+        return state
+
+    def import_objects(self, state: ZoneState, zone: int) -> None:
+        # The stored state is at least as recent as anything loaded from the database in the meantime
+        for oid, (class_number, version, hydrated, fields) in state.items():
+            self.evicted.pop(oid, None)
+            self.assign_zone(oid, zone)
+            memory = self.query_memory.setdefault(oid, {})
+            field_versions = self.field_versions.setdefault(oid, {})
+            for field, (field_version, value) in fields.items():
+                memory[field] = value
+                field_versions[field] = field_version
+            self.versions[oid] = max(self.versions.get(oid, 0), version)
+            self.version_counter = max(self.version_counter, version)
+            if hydrated:
+                self.hydrated.add(oid)
+
+            if class_number is not None:
+                self.object_classes[oid] = class_number
+                # The stored state is deleted once loaded, the journal has to know about it again
+                if self.journal is not None:
+                    for field, (_, value) in fields.items():
+                        self.journal.append(encode_record(class_number, oid, field, value))
+
+    def evict_zone(self, zone: int) -> int:
+        # Saves the RAM state of every object of the zone to the zone store and drops it from memory
+        oids = self.zone_objects.get(zone)
+        if not oids:
+            return 0
+
+        # forget empties the set of the zone
+        count = len(oids)
+        self.zone_store.save_zone_state(zone, encode_zone_state(self.export_objects(oids)))
+        for oid in list(oids):
+            self.forget(oid)
+            self.evicted[oid] = zone
+        return count
+
+    def load_zone(self, zone: int) -> None:
+        # Loads the zone back if it was evicted, then everything stored in the database for it
+        data = self.zone_store.load_zone_state(zone) if self.zone_states else None
+        if data is not None:
+            self.import_objects(decode_zone_state(data), zone)
+        self.prefetch_zone(zone)
+
+    def get_zone_metrics(self) -> dict[int, dict[str, int]]:
+        # Object and field counts and the serialized size of the RAM state of every zone in memory
+        metrics = {}
+        for zone, oids in self.zone_objects.items():
+            metrics[zone] = {
+                'objects': len(oids),
+                'fields': sum(len(self.query_memory.get(oid, ())) for oid in oids),
+                'bytes': len(encode_zone_state(self.export_objects(oids))),
+            }
+        return metrics
+
+    def save_snapshot(self) -> None:
+        if not self.snapshots:
+            raise ValueError(f'{self.db_interface.__class__.__name__} does not support snapshots')
+        self.db_interface.save_snapshot(self.query_memory)
+
+    def load_snapshot(self) -> None:
+        if not self.snapshots:
+            raise ValueError(f'{self.db_interface.__class__.__name__} does not support snapshots')
+        for oid, fields in self.db_interface.load_snapshot().items():
+            self.load_fields(oid, fields)
+        # Database fields in the snapshot are at least as recent as the ones in the database
+        self.hydrated.update(oid for oid in self.query_memory if self.is_database_object(oid))
+
+    def recover(self) -> None:
+        # Must be called after the message registry is configured, as the records are decoded with it
+        for record in self.journal.recover():
+            class_number, oid, field, value = decode_record(record)
+            if class_number == DeletedObject:
+                self.forget(oid, journal=False)
+                continue
+
+            self.object_classes[oid] = class_number
+            self.load_fields(oid, {field: value}, overwrite=True)
+        self.hydrated.update(oid for oid in self.query_memory if self.is_database_object(oid))
+
+    def forget(self, oid: ObjectID, journal: bool = True) -> None:
+        # Drops the RAM state of an object that left the server, database objects are hydrated again when needed
+        self.query_memory.pop(oid, None)
+        self.versions.pop(oid, None)
+        self.field_versions.pop(oid, None)
+        self.hydrated.discard(oid)
+        self.evicted.pop(oid, None)
+        zone = self.object_zones.pop(oid, None)
+        if zone is not None:
+            self.zone_objects[zone].discard(oid)
+            if not self.zone_objects[zone]:
+                del self.zone_objects[zone]
+        if self.object_classes.pop(oid, None) is not None and journal and self.journal is not None:
+            self.journal.append(encode_deletion(oid))
+
+    def get_records(self) -> Iterator[bytes]:
+        for oid, fields in self.query_memory.items():
+            class_number = self.object_classes.get(oid)
+            if class_number is None:
+                continue
+
+            for field, value in fields.items():
+                yield encode_record(class_number, oid, field, value)
+
+    def update_journal(self) -> None:
+        if self.journal is not None:
+            self.journal.update(self.get_records)
+
+    def set_data(self, oid: ObjectID, field: str, value, update_db: bool = False, class_number: int = None,
+                 record: bytes = None):
+        # record is the update in the wire encoding if the caller has it already, saves encoding it again.
+        # Hydrating first, as loading an evicted zone back journals its stored values, which are older.
+        self.hydrate(oid)
+        if class_number is not None:
+            self.object_classes[oid] = class_number
+            if self.journal is not None:
+                self.journal.append(record or encode_record(class_number, oid, field, value))
 
-    def set_data(self, oid: ObjectID, field: str, value, update_db: bool = False):
         if oid not in self.query_memory:
             self.query_memory[oid] = {}
+            self.field_versions[oid] = {}
 
+        version = self.next_version()
+        self.versions[oid] = version
         self.query_memory[oid][field] = value
-        if update_db and not isinstance(oid, int):
+        self.field_versions[oid][field] = version
+        if update_db and self.is_database_object(oid):
             self.db_interface.update_object(oid, field, value)
 
-    def pack_object(self, obj: SNetworkNode, dg: PyDatagram) -> None:
+    def get_data(self, oid: ObjectID, field: str, default=None):
+        self.hydrate(oid)
+        return self.query_memory.get(oid, {}).get(field, default)
+
+    def get_version(self, oid: ObjectID) -> int:
+        return self.versions.get(oid, 0)
+
+    def pack_object(self, obj: SNetworkNode, dg: PyDatagram, since_version: int = 0) -> None:
+        # Packs the object version and the fields the client does not have if it holds the object at since_version
+        self.hydrate(obj.oid)
         if obj.oid not in self.query_memory:
             self.query_memory[obj.oid] = {}
+            self.field_versions[obj.oid] = {}
 
+        memory = self.query_memory[obj.oid]
+        field_versions = self.field_versions[obj.oid]
         compilation_data = []
 
         sclass = obj.director.type_index[obj.ClassNumber]
         for field, data in sclass.configurations.items():
             message_name = sclass.get_message_name(field)
-            if message_name in self.query_memory[obj.oid]:
-                compilation_data.append((field, message_name, self.query_memory[obj.oid][message_name]))
+            if message_name in memory:
+                if field_versions.get(message_name, 0) > since_version:
+                    compilation_data.append((message_name, memory[message_name]))
             elif data.default is not None:
-                compilation_data.append((field, message_name, data.default))
+                if not since_version:
+                    compilation_data.append((message_name, self.as_args(data.default)))
             elif data.flags & Flags.Required:
-                default_data = getattr(obj, f'get_{message_name}')
-                compilation_data.append((field, message_name, default_data))
+                # Not stored anywhere, so the client copy can never be considered up to date
+                compilation_data.append((message_name, self.as_args(getattr(obj, f'get_{message_name}')())))
 
+        dg.addUint32(self.get_version(obj.oid))
         dg.addUint16(len(compilation_data))
-        for field_number, message_name, data in compilation_data:
-            print(field_number, message_name, data)
-            dg.addUint16(field_number)
-            sclass.compile_datagram(message_name, data, dg)
+        for message_name, data in compilation_data:
+            sclass.compile_datagram(message_name, *data, init_datagram=dg)
+
+    @staticmethod
+    def as_args(value) -> tuple[...]:
+        return value if isinstance(value, tuple) else (value, )
@@ -1,49 +1,115 @@
 import builtins
-from typing import Type, cast
+import time
+import zlib
+from typing import Callable, Collection, Type, cast
 
 from direct.distributed.PyDatagram import PyDatagram
 from direct.distributed.PyDatagramIterator import PyDatagramIterator
 from direct.showbase import EventManagerGlobal, MessengerGlobal, DConfig
 from direct.task import TaskManagerGlobal
 from direct.task.Task import Task
-from panda3d.core import PointerToConnection, QueuedConnectionListener, NetAddress, NetDatagram
+from panda3d.core import Connection, PointerToConnection, QueuedConnectionListener, NetAddress, Datagram
 
 from libpuns.connection.connection import MessageDirector
-from libpuns.connection.connection_globals import KickReason, SpecialMessage
-from libpuns.connection.datagram_util import ObjectID, add_object_id, extract_object_id
+from libpuns.connection.connection_globals import KickReason, SpecialMessage, Capability, SupportedCapabilities
+from libpuns.connection.datagram_util import CallbackConfig, ObjectID, add_object_id, extract_object_id
 from libpuns.connection.message_registry import MsgRegistry, Flags
 from libpuns.connection.network_node import NetworkNode
+from libpuns.connection.rate_limit import RateLimit, RatePolicy, TokenBucket
+from libpuns.connection.rpc import RpcError, RpcFuture, RpcStatus
+from libpuns.connection.schema_transcoder import SchemaTranscoder
+from libpuns.connection.timer_wheel import TimerWheel
+from libpuns.connection.traffic_recorder import TrafficRecorder, RecordKind
+from libpuns.server.client_connection import ClientConnection, ConnectionState
 from libpuns.server.database_interface import DatabaseInterface
+from libpuns.server.deferred_executor import DeferredExecutor
+from libpuns.server.journal import Journal
 from libpuns.server.memory_handler import MemoryHandler
 from libpuns.server.server_node import SNetworkNode
+from libpuns.server.tick_scheduler import TickScheduler
+from libpuns.server.zone_store import ZoneStore
 
 
 class ServerMessageDirector(MessageDirector):
-    partial_connections: list[PointerToConnection]
+    connections: dict[PointerToConnection, ClientConnection]
     identified_connections: dict[ObjectID, PointerToConnection]
     reverse_identified_connections: dict[PointerToConnection, ObjectID]
     db_interface: DatabaseInterface
     zone_connections: dict[int, set[ObjectID]]
-    reverse_zone_connections: dict[ObjectID, int]
+    # Clients can be in several zones at once
+    reverse_zone_connections: dict[ObjectID, set[int]]
     objects: dict[ObjectID, SNetworkNode]
-
-    def __init__(self, db_interface: DatabaseInterface, player_class: Type[SNetworkNode]):
-        super().__init__()
+    zone_send_rates: dict[int, float]
+    zone_next_send: dict[int, float]
+    zone_snapshots: dict[int, dict[tuple[ObjectID, str], bytes]]
+    transcoders: dict[int, SchemaTranscoder]
+    throttled: dict[TokenBucket, PointerToConnection]
+    rate_limit_metrics: dict[str, dict[str, int]]
+
+    # Panda3D datagrams are prefixed with a 16-bit length, keep some headroom
+    MaxDatagramSize = 60000
+
+    def __init__(self, db_interface: DatabaseInterface, player_class: Type[SNetworkNode], deferred_workers: int = 4,
+                 tick_rate: int = 30, snapshot_rate: float | None = None, journal: Journal = None,
+                 schema_history: int = 2, capabilities: int = SupportedCapabilities, compression_threshold: int = 1024,
+                 login_timeout: float = 10, idle_timeout: float = 30, heartbeat_interval: float = 5,
+                 recorder: TrafficRecorder = None, zone_idle_timeout: float | None = None,
+                 zone_store: ZoneStore = None, rate_limit: RateLimit = None, rpc_timeout: float = 10):
+        super().__init__(rpc_timeout)
+        self.rpc.max_datagram_size = self.MaxDatagramSize
         self.class_index = MsgRegistry.ServerTypeIndex
         self.player_class = player_class
         self.listener = QueuedConnectionListener(self.connman, 0)
-        self.partial_connections = []
+        self.connections = {}
         self.identified_connections = {}
         self.db_interface = db_interface
-        self.memory_handler = MemoryHandler(db_interface)
+        self.memory_handler = MemoryHandler(db_interface, journal, zone_store, zone_idle_timeout is not None)
+        self.deferred = DeferredExecutor(deferred_workers)
+        self.tick_scheduler = TickScheduler(tick_rate)
+
+        # snapshot_rate=None sends every update immediately, otherwise RAM broadcasts are coalesced per zone
+        self.snapshot_rate = snapshot_rate
+        self.zone_send_rates = {}
+        self.zone_next_send = {}
+        self.zone_snapshots = {}
 
         self.zone_connections = {}
         self.reverse_zone_connections = {}
+        # Zones without clients for zone_idle_timeout seconds are evicted to the zone store (the database by default)
+        self.zone_idle_timeout = zone_idle_timeout
+        self.zone_timers = TimerWheel(resolution=1)
         self.reverse_identified_connections = {}
 
+        # Clients may use any of the schema_history schema versions preceding the current one
+        self.schema_history = schema_history
+        self.capabilities = capabilities
+        self.compression_threshold = compression_threshold
+        self.transcoders = {}
+
+        # Connections are kicked if they do not log in within login_timeout, or stay silent for idle_timeout
+        # while being sent a heartbeat every heartbeat_interval
+        self.login_timeout = login_timeout
+        self.idle_timeout = idle_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.login_timers = TimerWheel()
+        self.next_heartbeat = 0.0
+        self.next_connection_id = 1
+        # Records the traffic for traffic_replay if set
+        self.recorder = recorder
+
+        # rate_limit applies to every datagram of a connection, the message rate limits are set in configure
+        self.rate_limit = rate_limit
+        self.throttled = {}
+        self.rate_limit_metrics = {}
+        # Called with the connections being dropped, before their socket is closed
+        self.on_drop: Callable[[PointerToConnection], None] | None = None
+
         self.register_special(SpecialMessage.ConnectionRequest, self.handle_connection_request)
         self.register_special(SpecialMessage.ZoneRequest, self.handle_zone_request)
         self.register_special(SpecialMessage.ObjectRequest, self.handle_object_request)
+        self.register_special(SpecialMessage.InterestAdd, self.handle_interest_add)
+        self.register_special(SpecialMessage.InterestRemove, self.handle_interest_remove)
+        self.register_special(SpecialMessage.Heartbeat, self.handle_heartbeat)
 
     def handle_object_request(self, conn: PointerToConnection, pdi: PyDatagramIterator):
         if conn not in self.reverse_identified_connections:
@@ -59,48 +125,130 @@ class ServerMessageDirector(MessageDirector):
             self.eject_client(conn, KickReason.PartialRequest)
             return
 
-        oid = extract_object_id(pdi)
-        if self.reverse_zone_connections.get(oid) != self.reverse_zone_connections.get(client_oid):
-            self.notify.warning(f'Client {self.get_connection_descriptor(conn)} used ObjectRequest in the wrong zone!')
-            self.eject_client(conn, KickReason.HiddenZone)
-            return
-
-        obj = self.objects[oid]
+        client_zones = self.reverse_zone_connections[client_oid]
+        oids = [extract_object_id(pdi) for i in range(pdi.getUint16())]
+        for oid in oids:
+            if oid not in self.objects or client_zones.isdisjoint(self.reverse_zone_connections.get(oid, ())):
+                self.notify.warning(f'Client {self.get_connection_descriptor(conn)} used ObjectRequest '
+                                    f'in the wrong zone!')
+                self.eject_client(conn, KickReason.HiddenZone)
+                return
+
+        dg = count = None
+        for oid in oids:
+            # Packed on its own first, so that the batch is split before it would grow past the limit
+            obj = self.objects[oid]
+            entry = PyDatagram()
+            add_object_id(entry, oid)
+            entry.addUint16(obj.ClassNumber)
+            self.memory_handler.pack_object(cast(SNetworkNode, obj), entry)
+
+            if dg is None or dg.getLength() + entry.getLength() > self.MaxDatagramSize or count == 0xFFFF:
+                if dg is not None:
+                    self.send_object_response(conn, dg, count)
+                dg, count = PyDatagram(), 0
+
+            dg.appendData(entry.getMessage())
+            count += 1
+
+        if dg is not None:
+            self.send_object_response(conn, dg, count)
+
+    def send_object_response(self, conn: PointerToConnection, objects: PyDatagram, count: int) -> None:
         dg = PyDatagram()
         dg.addUint16(SpecialMessage.ObjectResponse)
-        add_object_id(dg, oid)
-        dg.addUint16(obj.ClassNumber)
-        self.memory_handler.pack_object(cast(SNetworkNode, obj), dg)
+        dg.addUint16(count)
+        dg.appendData(objects.getMessage())
         self.send_datagram(conn, dg)
 
-    def generate_with_zone(self, obj: SNetworkNode, zone: int):
-        if zone not in self.zone_connections:
-            self.zone_connections[zone] = set()
-
-        dg = PyDatagram()
-        dg.addUint16(SpecialMessage.ObjectResponse)
-        add_object_id(dg, obj.oid)
-        dg.addUint16(obj.ClassNumber)
-        self.memory_handler.pack_object(cast(SNetworkNode, obj), dg)
-        self.broadcast_to_zone(zone, dg)
-
+    def make_zone_data(self, zone: int, members: Collection[ObjectID], oids: Collection[ObjectID],
+                       known_versions: dict[ObjectID, int] = None) -> PyDatagram:
+        # members are already seen by the client and only listed, so that it knows which zones they are in
+        known_versions = known_versions or {}
         dg = PyDatagram()
         dg.addUint16(SpecialMessage.ZoneData)
         dg.addUint32(zone)
-        dg.addUint16(len(self.zone_connections[zone]))
-        for x in self.zone_connections[zone]:
+        dg.addUint16(len(members))
+        for x in members:
+            add_object_id(dg, x)
+        dg.addUint16(len(oids))
+        for x in oids:
             add_object_id(dg, x)
             dg.addUint16(self.objects[x].ClassNumber)
-            self.memory_handler.pack_object(cast(SNetworkNode, self.objects[x]), dg)
-        self.send_datagram(self.identified_connections[obj.oid], dg)
+            self.memory_handler.pack_object(cast(SNetworkNode, self.objects[x]), dg, known_versions.get(x, 0))
+        return dg
 
-        self.zone_connections[zone].add(obj.oid)
+    def generate_with_zone(self, obj: SNetworkNode, zone: int, known_versions: dict[ObjectID, int] = None,
+                           visible: set[ObjectID] = frozenset()):
+        # visible holds the clients sharing another zone with obj: they already see each other
+        if zone not in self.zone_connections:
+            self.zone_connections[zone] = set()
 
-    def disconnect_from_zone(self, oid: ObjectID):
-        if oid in self.reverse_zone_connections:
-            current_zone = self.reverse_zone_connections[oid]
+        full, listed = self.make_zone_data(zone, (), (obj.oid, )), self.make_zone_data(zone, (obj.oid, ), ())
+        full_encoded, listed_encoded = {}, {}
+        for oid in self.zone_connections[zone]:
+            if oid == obj.oid:
+                continue
+            elif oid in visible:
+                self.send_datagram(self.identified_connections[oid], listed, listed_encoded)
+            else:
+                self.send_datagram(self.identified_connections[oid], full, full_encoded)
+
+        members = self.zone_connections[zone]
+        members.add(obj.oid)
+        self.send_datagram(self.identified_connections[obj.oid],
+                           self.make_zone_data(zone, members.intersection(visible), members.difference(visible),
+                                               known_versions))
+
+    def disconnect_from_zone(self, oid: ObjectID, zone: int = None):
+        # Leaves the given zone, or every zone
+        zones = self.reverse_zone_connections.get(oid)
+        if not zones:
+            return
+
+        visible = set(self.get_zone_recipients(zones))
+        for current_zone in list(zones) if zone is None else [zone]:
+            zones.discard(current_zone)
+            self.zone_connections[current_zone].discard(oid)
+            if not self.zone_connections[current_zone]:
+                del self.zone_connections[current_zone]
+                self.zone_snapshots.pop(current_zone, None)
+                self.zone_next_send.pop(current_zone, None)
+                if self.zone_idle_timeout is not None:
+                    self.zone_timers.schedule(current_zone, self.zone_idle_timeout)
+        if not zones:
             del self.reverse_zone_connections[oid]
-            self.zone_connections[current_zone].remove(oid)
+
+        # Tell the clients that do not share a zone with the object anymore
+        visible.difference_update(self.get_zone_recipients(zones) if zones else ())
+        visible.discard(oid)
+        if visible:
+            dg = PyDatagram()
+            dg.addUint16(SpecialMessage.ObjectLeave)
+            add_object_id(dg, oid)
+            encoded = {}
+            for client_oid in visible:
+                self.send_datagram(self.identified_connections[client_oid], dg, encoded)
+
+    def read_zone_request(self, conn: PointerToConnection, pdi: PyDatagramIterator) -> tuple[int, dict[ObjectID, int]]:
+        zone = pdi.getUint32()
+        known_versions = {}
+        for i in range(pdi.getUint16()):
+            known_oid = extract_object_id(pdi)
+            known_versions[known_oid] = pdi.getUint32()
+        if not self.connections[conn].capabilities & Capability.DeltaEncoding:
+            known_versions = {}
+        return zone, known_versions
+
+    def add_to_zone(self, oid: ObjectID, zone: int, known_versions: dict[ObjectID, int]) -> None:
+        zones = self.reverse_zone_connections.setdefault(oid, set())
+        visible = set(self.get_zone_recipients(zones))
+        if not self.zone_connections.get(zone):
+            # The zone becomes active, load it back if it was evicted and everything stored in it at once
+            self.zone_timers.cancel(zone)
+            self.memory_handler.load_zone(zone)
+        zones.add(zone)
+        self.generate_with_zone(self.objects[oid], zone, known_versions, visible)
 
     def handle_zone_request(self, conn: PointerToConnection, pdi: PyDatagramIterator):
         if conn not in self.reverse_identified_connections:
@@ -110,38 +258,288 @@ class ServerMessageDirector(MessageDirector):
 
         oid = self.reverse_identified_connections[conn]
         self.disconnect_from_zone(oid)
-        zone = pdi.getUint32()
-        self.reverse_zone_connections[oid] = zone
-        if zone not in self.zone_connections:
-            self.zone_connections[zone] = set()
-        self.zone_connections[zone].add(oid)
+        zone, known_versions = self.read_zone_request(conn, pdi)
+        self.memory_handler.set_object_zone(oid, zone)
 
         dg = PyDatagram()
         dg.addUint16(SpecialMessage.ZoneResponse)
         dg.addUint32(zone)
         self.send_datagram(conn, dg)
-        self.generate_with_zone(self.objects[oid], zone)
+        self.add_to_zone(oid, zone, known_versions)
+
+    def handle_interest_add(self, conn: PointerToConnection, pdi: PyDatagramIterator):
+        oid = self.reverse_identified_connections.get(conn)
+        if oid not in self.reverse_zone_connections:
+            self.notify.warning(f'Client {self.get_connection_descriptor(conn)} used InterestAdd while not in a zone')
+            self.eject_client(conn, KickReason.PartialRequest)
+            return
+
+        zone, known_versions = self.read_zone_request(conn, pdi)
+        if zone not in self.reverse_zone_connections[oid]:
+            self.add_to_zone(oid, zone, known_versions)
+
+    def handle_interest_remove(self, conn: PointerToConnection, pdi: PyDatagramIterator):
+        oid = self.reverse_identified_connections.get(conn)
+        if oid not in self.reverse_zone_connections:
+            self.notify.warning(f'Client {self.get_connection_descriptor(conn)} used InterestRemove '
+                                f'while not in a zone')
+            self.eject_client(conn, KickReason.PartialRequest)
+            return
+
+        zone = pdi.getUint32()
+        zones = self.reverse_zone_connections[oid]
+        # The last zone can only be left by moving to another one
+        if zone not in zones or len(zones) == 1:
+            return
+
+        self.disconnect_from_zone(oid, zone)
+        if self.memory_handler.object_zones.get(oid) == zone:
+            self.memory_handler.set_object_zone(oid, next(iter(zones)))
+
+    def get_zone_recipients(self, zones: Collection[int]) -> set[ObjectID]:
+        # Every client in any of the zones, once
+        if len(zones) == 1:
+            for zone in zones:
+                return self.zone_connections.get(zone, set())
+
+        recipients = set()
+        for zone in zones:
+            recipients.update(self.zone_connections.get(zone, ()))
+        return recipients
+
+    def get_home_zone(self, oid: ObjectID) -> int | None:
+        # The zone owning the object if it is in it, any of its zones otherwise
+        zones = self.reverse_zone_connections.get(oid)
+        if not zones:
+            return None
+
+        zone = self.memory_handler.object_zones.get(oid)
+        return zone if zone in zones else next(iter(zones))
 
     def broadcast_to_zone(self, zone: int, datagram: PyDatagram, ignore: ObjectID = None) -> None:
         if zone not in self.zone_connections:
             self.notify.warning(f'Trying to broadcast to a zone {zone} that does not exist!')
             return
 
-        for oid in self.zone_connections[zone]:
+        self.broadcast_to_zones([zone], datagram, ignore)
+
+    def broadcast_to_zones(self, zones: Collection[int], datagram: PyDatagram, ignore: ObjectID = None) -> None:
+        # Every client with the same schema version and capabilities receives the same bytes
+        encoded = {}
+        for oid in self.get_zone_recipients(zones):
             if oid == ignore:
                 continue
 
-            self.send_datagram(self.identified_connections[oid], datagram)
+            self.send_datagram(self.identified_connections[oid], datagram, encoded)
+
+    def set_zone_send_rate(self, zone: int, rate: float | None) -> None:
+        self.zone_send_rates[zone] = rate
+        if rate is None:
+            self.flush_zone_snapshot(zone)
+
+    def get_zone_send_rate(self, zone: int) -> float | None:
+        return self.zone_send_rates.get(zone, self.snapshot_rate)
+
+    def add_tick_callback(self, obj: SNetworkNode, callback) -> None:
+        if not self.deferred.capture(self.tick_scheduler.add_callback, callback, obj.oid):
+            self.tick_scheduler.add_callback(callback, obj.oid)
+
+    def remove_tick_callback(self, obj: SNetworkNode, callback) -> None:
+        if not self.deferred.capture(self.tick_scheduler.remove_callback, callback, obj.oid):
+            self.tick_scheduler.remove_callback(callback, obj.oid)
+
+    def run_on_main_loop(self, callback: Callable[..., None], *args) -> None:
+        # Deferred handlers use it to change the server state, the callback runs once the handler completed
+        if not self.deferred.capture(callback, *args):
+            callback(*args)
+
+    def send_node_update(self, obj: SNetworkNode, message_type: str, args: tuple[...], **kwargs) -> None:
+        if self.deferred.capture(self.send_node_update, obj, message_type, args, **kwargs):
+            return
+
+        cindex = self.class_index[obj.DClass]
+        cdef = self.type_index[cindex]
+        flags = cdef.get_flags(message_type)
+        dg = PyDatagram()
+        dg.addUint16(cindex)
+        add_object_id(dg, obj.oid)
+        dg = cdef.compile_datagram(message_type, *args, init_datagram=dg)
+        if flags & Flags.RAM:
+            self.memory_handler.set_data(obj.oid, message_type, args,
+                                         update_db=flags & Flags.Database == Flags.Database,
+                                         class_number=cindex, record=dg.getMessage())
+
+        # Updates that skip some of the receivers are events rather than state, so they are never coalesced.
+        # Objects in several zones are coalesced in their home zone and sent to the clients of all of them.
+        zone = self.get_home_zone(obj.oid)
+        if flags & Flags.RAM and flags & Flags.Broadcast and zone is not None and not kwargs \
+                and self.get_zone_send_rate(zone) is not None:
+            self.zone_snapshots.setdefault(zone, {})[obj.oid, message_type] = dg.getMessage()
+            return
+
+        self.send_datagram_to(obj, flags, dg, **kwargs)
+
+    def flush_zone_snapshot(self, zone: int) -> None:
+        entries = self.zone_snapshots.pop(zone, None)
+        if not entries:
+            return
+
+        # Entries are grouped by the zones of their object, so that every client receives each of them once
+        groups = {}
+        for (oid, _), entry in entries.items():
+            zones = self.reverse_zone_connections.get(oid)
+            if zones:
+                groups.setdefault(frozenset(zones), []).append(entry)
+
+        for zones, group in groups.items():
+            self.send_snapshot_entries(self.get_zone_recipients(zones), group)
+
+    def send_snapshot_entries(self, recipients: set[ObjectID], entries: list[bytes]) -> None:
+        bundled = [oid for oid in recipients
+                   if self.connections[self.identified_connections[oid]].capabilities & Capability.Bundling]
+        if len(bundled) != len(recipients):
+            # Clients that cannot parse snapshots get the entries as regular updates
+            unbundled = recipients.difference(bundled)
+            for entry in entries:
+                dg, encoded = PyDatagram(entry), {}
+                for oid in unbundled:
+                    self.send_datagram(self.identified_connections[oid], dg, encoded)
+
+        if not bundled:
+            return
+
+        dg = count = None
+        for entry in entries:
+            if dg is None or dg.getLength() + len(entry) > self.MaxDatagramSize or count == 0xFFFF:
+                if dg is not None:
+                    self.send_snapshot(bundled, dg, count)
+                dg, count = PyDatagram(), 0
 
-    def parse_message(self, message: NetDatagram) -> None:
+            dg.appendData(entry)
+            count += 1
+        self.send_snapshot(bundled, dg, count)
+
+    def send_snapshot(self, receivers: list[ObjectID], entries: PyDatagram, count: int) -> None:
+        dg = PyDatagram()
+        dg.addUint16(SpecialMessage.Snapshot)
+        dg.addUint32(self.tick_scheduler.tick)
+        dg.addUint16(count)
+        dg.appendData(entries.getMessage())
+        encoded = {}
+        for oid in receivers:
+            self.send_datagram(self.identified_connections[oid], dg, encoded)
+
+    def poll_ticks(self, task: Task):
+        self.run_ticks(time.monotonic())
+        return task.cont
+
+    def run_ticks(self, now: float) -> None:
+        self.tick_scheduler.update(now)
+
+        for zone in list(self.zone_snapshots):
+            rate = self.get_zone_send_rate(zone)
+            if rate is None:
+                self.flush_zone_snapshot(zone)
+            elif now >= self.zone_next_send.get(zone, 0):
+                self.zone_next_send[zone] = now + 1 / rate
+                self.flush_zone_snapshot(zone)
+
+    def handle_datagram(self, conn: PointerToConnection, datagram: Datagram) -> None:
+        info = self.connections.get(conn)
+        if info is None:
+            # Left in the reader queue by a connection that was dropped since
+            return
+
+        now = info.last_seen = time.monotonic()
+        if self.recorder is not None:
+            self.recorder.record(RecordKind.Inbound, info.connection_id, self.recorder.redact(datagram))
+
+        if self.rate_limit is not None:
+            if info.rate_bucket is None:
+                info.rate_bucket = TokenBucket(self.rate_limit, now)
+            if info.rate_bucket.pending or not info.rate_bucket.take(now):
+                self.limit_message(conn, info.rate_bucket, 'connection', lambda: self.dispatch_datagram(conn, datagram))
+                return
+
+        self.dispatch_datagram(conn, datagram)
+
+    def dispatch_datagram(self, conn: PointerToConnection, datagram: Datagram) -> None:
         try:
-            super().parse_message(message)
+            super().handle_datagram(conn, datagram)
         except ValueError as e:
             self.notify.warning(f'Error parsing message: {str(e)}')
-            self.eject_client(message.getConnection(), KickReason.InvalidMessage)
+            self.eject_client(conn, KickReason.InvalidMessage)
+
+    def limit_message(self, conn: PointerToConnection, bucket: TokenBucket, name: str,
+                      handle: Callable[[], None]) -> str:
+        # Called for messages over the limit or queued behind throttled ones, which keeps their order.
+        # Returns what happened to the message: dropped, throttled or kicked.
+        policy = bucket.limit.policy
+        if policy == RatePolicy.Throttle and bucket.defer(handle):
+            self.throttled[bucket] = conn
+            outcome = 'throttled'
+        elif policy == RatePolicy.Kick:
+            outcome = 'kicked'
+        else:
+            outcome = 'dropped'
+
+        metrics = self.rate_limit_metrics.setdefault(name, {'dropped': 0, 'throttled': 0, 'kicked': 0})
+        metrics[outcome] += 1
+        self.connections[conn].rate_limited += 1
+        if policy == RatePolicy.Kick:
+            self.notify.warning(f'Client {self.get_connection_descriptor(conn)} exceeded the rate limit of {name}')
+            self.eject_client(conn, KickReason.RateLimited)
+        return outcome
+
+    def release_throttled(self, now: float) -> None:
+        for bucket, conn in list(self.throttled.items()):
+            while bucket.pending and conn in self.connections and bucket.take(now):
+                bucket.pending.popleft()()
+            if not bucket.pending or conn not in self.connections:
+                self.throttled.pop(bucket, None)
+
+    def get_rate_limit_metrics(self) -> dict[str, dict[str, int]]:
+        # Messages over the limits per rate limit name ('connection' or Class.message) and outcome
+        return {name: dict(metrics) for name, metrics in self.rate_limit_metrics.items()}
+
+    def get_transcoder(self, version: int) -> SchemaTranscoder:
+        if version not in self.transcoders:
+            self.transcoders[version] = SchemaTranscoder(MsgRegistry.TypeIndex, MsgRegistry.get_type_index(version),
+                                                         MsgRegistry.get_converters(version))
+        return self.transcoders[version]
+
+    def encode_datagram(self, info: ClientConnection, datagram: PyDatagram) -> PyDatagram | None:
+        if info.schema_version != MsgRegistry.SchemaVersion:
+            datagram = self.get_transcoder(info.schema_version).transcode(datagram)
+            if datagram is None:
+                return None
+
+        if info.capabilities & Capability.Compression and datagram.getLength() > self.compression_threshold:
+            compressed = PyDatagram()
+            compressed.addUint16(SpecialMessage.Compressed)
+            compressed.addBlob32(zlib.compress(datagram.getMessage()))
+            datagram = compressed
+        return datagram
+
+    def send_datagram(self, connection: PointerToConnection, datagram: PyDatagram,
+                      encoded: dict[tuple[int, int], PyDatagram | None] = None) -> None:
+        # encoded caches the datagram per schema version and capabilities when sending the same one to many clients
+        info = self.connections.get(connection)
+        if info is None:
+            return
+
+        key = info.schema_version, info.capabilities
+        if encoded is not None and key in encoded:
+            datagram = encoded[key]
+        else:
+            datagram = self.encode_datagram(info, datagram)
+            if encoded is not None:
+                encoded[key] = datagram
 
-    def send_datagram(self, connection: PointerToConnection, datagram: PyDatagram) -> None:
-        self.writer.send(datagram, connection)
+        if datagram is not None:
+            if self.recorder is not None:
+                self.recorder.record(RecordKind.Outbound, info.connection_id, datagram.getMessage())
+            self.writer.send(datagram, connection)
 
     def get_connection_descriptor(self, conn: PointerToConnection) -> str:
         if conn in self.reverse_identified_connections:
@@ -154,26 +552,57 @@ class ServerMessageDirector(MessageDirector):
         dg.addUint16(SpecialMessage.Disconnect)
         dg.addUint8(kick_reason)
         self.send_datagram(conn, dg)
+        self.drop_connection(conn)
+        # Also removes it from the reader
+        self.connman.closeConnection(conn)
+
+    def drop_connection(self, conn: PointerToConnection) -> None:
+        # Forgets the connection along with its player object, zone membership, tick callbacks and RAM state
+        info = self.connections.pop(conn, None)
+        if info is None:
+            return
 
-        if conn in self.reverse_identified_connections:
-            user_id = self.reverse_identified_connections[conn]
-            del self.identified_connections[user_id]
-            self.disconnect_from_zone(user_id)
-            del self.reverse_identified_connections[conn]
-        self.reader.removeConnection(conn)
+        info.close()
+        if self.on_drop is not None:
+            self.on_drop(conn)
+        self.login_timers.cancel(conn)
+        self.rpc.fail_destination(conn)
+        for bucket in info.get_buckets():
+            self.throttled.pop(bucket, None)
+        if self.recorder is not None:
+            self.recorder.record(RecordKind.Closed, info.connection_id)
+        oid = info.oid
+        if oid is None:
+            return
+
+        del self.identified_connections[oid]
+        del self.reverse_identified_connections[conn]
+        self.disconnect_from_zone(oid)
+        self.tick_scheduler.remove_object(oid)
+        obj = self.objects.pop(oid, None)
+        if obj is not None:
+            obj.ignoreAll()
+        self.memory_handler.forget(oid)
 
     def handle_connection_request(self, conn: PointerToConnection, pdi: PyDatagramIterator) -> None:
-        if conn not in self.partial_connections:
+        info = self.connections.get(conn)
+        if info is None or info.state != ConnectionState.Partial:
             self.eject_client(conn, KickReason.InvalidConnectionRequest)
             return
 
         signature_hash = pdi.getBlob()
+        schema_version = pdi.getUint16()
+        capabilities = pdi.getUint32()
         login = pdi.getString()
         token = pdi.getString()
 
-        if self.signature != signature_hash:
-            self.notify.warning(f'Signature mismatch from {self.get_connection_descriptor(conn)}: '
-                                f'expected {self.signature}, got {signature_hash}')
+        expected_signature = None
+        if MsgRegistry.SchemaVersion - self.schema_history <= schema_version <= MsgRegistry.SchemaVersion:
+            expected_signature = MsgRegistry.get_version_signature(schema_version)
+        if expected_signature != signature_hash:
+            self.notify.warning(f'Signature mismatch from {self.get_connection_descriptor(conn)} '
+                                f'with schema version {schema_version}: expected {expected_signature}, '
+                                f'got {signature_hash}')
             self.eject_client(conn, KickReason.InvalidSignature)
             return
 
@@ -187,7 +616,8 @@ class ServerMessageDirector(MessageDirector):
 
         self.reverse_identified_connections[conn] = oid
         self.identified_connections[oid] = conn
-        self.partial_connections.remove(conn)
+        self.login_timers.cancel(conn)
+        info.identify(oid, schema_version, capabilities & self.capabilities, time.monotonic())
         self.objects[oid] = self.player_class(self, oid)
         self.objects[oid].transfer_owner(oid)
 
@@ -195,6 +625,9 @@ class ServerMessageDirector(MessageDirector):
         dg.addUint16(SpecialMessage.ConnectionResponse)
         add_object_id(dg, oid)
         dg.addUint32(0)  # Zone ID
+        dg.addUint16(self.tick_scheduler.tick_rate)
+        dg.addUint32(info.capabilities)
+        dg.addUint32(self.memory_handler.epoch)
         self.send_datagram(conn, dg)
 
     def send_datagram_to(self, obj: ObjectID | NetworkNode, flags: int, datagram: PyDatagram,
@@ -204,6 +637,10 @@ class ServerMessageDirector(MessageDirector):
         else:
             oid = obj
 
+        if self.deferred.capture(self.send_datagram_to, obj, flags, datagram, bypass_zone_required=bypass_zone_required,
+                                 broadcast_ignore=broadcast_ignore, **kwargs):
+            return
+
         if not bypass_zone_required and oid not in self.reverse_zone_connections:
             self.notify.warning(f'Trying to send datagram to object {oid} without zone')
             if oid in self.identified_connections:
@@ -211,7 +648,7 @@ class ServerMessageDirector(MessageDirector):
             return
 
         if flags & Flags.Broadcast:
-            self.broadcast_to_zone(self.reverse_zone_connections[oid], datagram, ignore=broadcast_ignore)
+            self.broadcast_to_zones(self.reverse_zone_connections[oid], datagram, ignore=broadcast_ignore)
         else:
             self.send_datagram(self.identified_connections[oid], datagram)
 
@@ -221,49 +658,339 @@ class ServerMessageDirector(MessageDirector):
             address = NetAddress()
             if self.listener.getNewConnection(rendezvous, address, connection):
                 connection_ptr = connection.p()
-                self.partial_connections.append(connection_ptr)
+                self.accept_connection(connection_ptr)
                 self.reader.addConnection(connection_ptr)
         return task.cont
 
-    def launch(self, port: int, configure_panda: bool = True) -> None:
+    def accept_connection(self, conn: PointerToConnection) -> ClientConnection:
+        now = time.monotonic()
+        info = self.connections[conn] = ClientConnection(conn, self.next_connection_id, now)
+        self.next_connection_id += 1
+        self.login_timers.schedule(conn, self.login_timeout, now)
+        if self.recorder is not None:
+            self.recorder.record(RecordKind.Opened, info.connection_id)
+        return info
+
+    def handle_heartbeat(self, conn: PointerToConnection, pdi: PyDatagramIterator) -> None:
+        # last_seen was already updated when parsing the message
+        sent = pdi.getUint32()
+        info = self.connections.get(conn)
+        if info is not None:
+            info.round_trip_time = ((self.get_milliseconds(time.monotonic()) - sent) & 0xFFFFFFFF) / 1000
+
+    @staticmethod
+    def get_milliseconds(now: float) -> int:
+        return int(now * 1000) & 0xFFFFFFFF
+
+    def poll_connections(self, task: Task):
+        if self.throttled:
+            self.release_throttled(time.monotonic())
+
+        # Connections closed by the peer are reported by the reader
+        while self.connman.resetConnectionAvailable():
+            connection = PointerToConnection()
+            if self.connman.getResetConnection(connection):
+                conn = connection.p()
+                self.notify.info(f'Client {self.get_connection_descriptor(conn)} disconnected')
+                self.drop_connection(conn)
+                self.connman.closeConnection(conn)
+
+        now = time.monotonic()
+        for conn in self.login_timers.advance(now):
+            self.notify.warning(f'Client {self.get_connection_descriptor(conn)} did not log in')
+            self.eject_client(conn, KickReason.Timeout)
+
+        if now >= self.next_heartbeat:
+            # Half-open connections are never reported, they just stop answering the heartbeats
+            self.next_heartbeat = now + self.heartbeat_interval
+            dg = PyDatagram()
+            dg.addUint16(SpecialMessage.Heartbeat)
+            dg.addUint32(self.get_milliseconds(now))
+            encoded = {}
+            for info in list(self.connections.values()):
+                if info.state != ConnectionState.Identified:
+                    continue
+
+                if now - info.last_seen > self.idle_timeout:
+                    self.notify.warning(f'Client {self.get_connection_descriptor(info.connection)} timed out')
+                    self.eject_client(info.connection, KickReason.Timeout)
+                else:
+                    self.send_datagram(info.connection, dg, encoded)
+        return task.cont
+
+    def poll_journal(self, task: Task):
+        self.memory_handler.update_journal()
+        return task.cont
+
+    def poll_zones(self, task: Task):
+        for zone in self.zone_timers.advance():
+            if not self.zone_connections.get(zone):
+                evicted = self.memory_handler.evict_zone(zone)
+                self.notify.info(f'Evicted {evicted} objects of idle zone {zone}')
+        return task.cont
+
+    def get_zone_metrics(self) -> dict[int, dict[str, int]]:
+        # Connected clients and the RAM state of every zone in memory
+        metrics = self.memory_handler.get_zone_metrics()
+        for zone, oids in self.zone_connections.items():
+            metrics.setdefault(zone, {'objects': 0, 'fields': 0, 'bytes': 0})['clients'] = len(oids)
+        for zone_metrics in metrics.values():
+            zone_metrics.setdefault('clients', 0)
+        return metrics
+
+    def poll_deferred(self, task: Task):
+        self.deferred.poll()
+        return task.cont
+
+    def save_snapshot(self) -> None:
+        self.memory_handler.save_snapshot()
+
+    def launch(self, port: int, configure_panda: bool = True, warm_restart: bool = False) -> None:
         if configure_panda:
             builtins.config = DConfig
             builtins.taskMgr = TaskManagerGlobal.taskMgr
             builtins.eventMgr = EventManagerGlobal.eventMgr
             builtins.messenger = MessengerGlobal.messenger
 
-        self.compile_signature()
-        rendezvous = self.connman.openTCPServerRendezvous(port, 1000)
-        self.listener.addConnection(rendezvous)
-        taskMgr.add(self.poll_rendezvous, 'Poll the connection listener', -39)
-        self.start_reader()
+        self.open(port, warm_restart)
+        for function, name, sort in self.get_tasks():
+            taskMgr.add(function, name, sort)
         self.notify.warning(f'Launched server on port {port}')
 
         if configure_panda:
             taskMgr.run()
 
-    def request_object_data(self, message: NetDatagram, oid: ObjectID):
+    def open(self, port: int, warm_restart: bool = False) -> Connection:
+        # Everything launch does but scheduling the tasks, for loops that run them on their own
+        self.compile_signature()
+        if warm_restart:
+            self.memory_handler.load_snapshot()
+        if self.memory_handler.journal is not None:
+            self.memory_handler.recover()
+        rendezvous = self.connman.openTCPServerRendezvous(port, 1000)
+        if not rendezvous:
+            raise ConnectionError(f'Could not listen on port {port}.')
+        self.listener.addConnection(rendezvous)
+        return rendezvous
+
+    def get_tasks(self) -> list[tuple[Callable[[Task], int], str, int]]:
+        # The polling functions of a running server with their task names and sorts, in the order they run
+        tasks = [
+            (self.poll_reader, 'Poll the connection reader', -40),
+            (self.poll_rendezvous, 'Poll the connection listener', -39),
+            (self.poll_connections, 'Reap closed and idle connections', -39),
+            (self.poll_deferred, 'Poll the deferred handlers', -38),
+            (self.poll_ticks, 'Run the simulation ticks', -37),
+        ]
+        if self.memory_handler.journal is not None:
+            tasks.append((self.poll_journal, 'Sync the RAM journal', -36))
+        if self.zone_idle_timeout is not None:
+            tasks.append((self.poll_zones, 'Evict the idle zones', -35))
+        tasks.append((self.poll_rpc, 'Send the batched remote calls', -34))
+        return tasks
+
+    def request_object_data(self, conn: PointerToConnection, datagram: Datagram | None, oid: ObjectID):
         self.notify.warning(f'Requested object data for ObjectID {oid}')
-        self.eject_client(message.getConnection(), KickReason.InvalidObjectID)
+        self.eject_client(conn, KickReason.InvalidObjectID)
+
+    def check_message(self, conn: PointerToConnection, obj: SNetworkNode, message_number: int,
+                      remote_call: bool = False) -> tuple[str, CallbackConfig] | None:
+        # Permissions only need the header, so rejected messages are never unpacked. Returns None if the client
+        # was kicked.
+        info = self.connections[conn]
+        if info.state != ConnectionState.Identified:
+            self.notify.warning(f'Received an update from unidentified client {self.get_connection_descriptor(conn)}')
+            self.eject_client(conn, KickReason.PartialRequest)
+            return None
+
+        schema_version = info.schema_version
+        typedef = MsgRegistry.get_type_index(schema_version).get(obj.ClassNumber)
+        if typedef is None:
+            raise ValueError(f'Class {obj.ClassNumber} does not exist in schema version {schema_version}')
+        if message_number not in typedef.configurations:
+            raise ValueError(f'Class {obj.ClassNumber} has no message {message_number}')
+
+        msg_name, cfg = typedef.get_message_data(message_number)
+        if (cfg.return_types is not None) != remote_call:
+            # Remote calls expect a response, they cannot be sent as plain messages and the other way around
+            raise ValueError(f'Message {msg_name} of class {obj.ClassNumber} was sent as the wrong kind of message')
+        if not (cfg.flags & Flags.ClientSend) and not (cfg.flags & Flags.OwnerSend and obj.owner == info.oid):
+            self.notify.warning(f'Received message {msg_name} from client {conn} without permission')
+            self.eject_client(conn, KickReason.PermissionDenied)
+            return None
+        return msg_name, cfg
+
+    def get_exceeded_bucket(self, conn: PointerToConnection, obj: SNetworkNode, msg_name: str,
+                            cfg: CallbackConfig) -> TokenBucket | None:
+        # Returns the bucket of the message rate limit if the message has to wait or be rejected
+        if cfg.rate_limit is None:
+            return None
+
+        now = time.monotonic()
+        bucket = self.connections[conn].get_message_bucket(obj.ClassNumber, msg_name, cfg.rate_limit, now)
+        if bucket.pending or not bucket.take(now):
+            return bucket
+        return None
 
     def decompile_datagram(self, conn: PointerToConnection, obj: SNetworkNode, pdi: PyDatagramIterator) -> None:
-        typedef = MsgRegistry.TypeIndex[obj.ClassNumber]
-        msg_name, msg_data = typedef.decompile_datagram(pdi)
-        flags = typedef.get_flags(msg_name)
+        message = self.check_message(conn, obj, pdi.getUint16())
+        if message is None:
+            return
 
-        client_oid = self.reverse_identified_connections.get(conn)
-        if client_oid is None:
-            self.notify.warning(f'Received message {msg_name} from unidentified client {conn}')
-            self.eject_client(conn, KickReason.PartialRequest)
+        msg_name, cfg = message
+        bucket = self.get_exceeded_bucket(conn, obj, msg_name, cfg)
+        if bucket is not None:
+            # The iterator does not keep the datagram alive, a throttled message needs its own copy
+            datagram = Datagram(pdi.getDatagram().getMessage())
+            deferred_pdi = PyDatagramIterator(datagram, pdi.getCurrentIndex())
+            self.limit_message(conn, bucket, f'{obj.__class__.__name__}.{msg_name}',
+                               lambda: self.apply_message(conn, obj, msg_name, cfg, cfg.unpack(deferred_pdi),
+                                                          datagram.getMessage()))
             return
 
-        if not (flags & Flags.ClientSend) and not (flags & Flags.OwnerSend and obj.owner == client_oid):
-            self.notify.warning(f'Received message {msg_name} from client {conn} without permission')
-            self.eject_client(conn, KickReason.PermissionDenied)
+        msg_data = cfg.unpack(pdi)
+        self.apply_message(conn, obj, msg_name, cfg, msg_data,
+                           pdi.getDatagram().getMessage() if cfg.flags & Flags.RAM else None)
+
+    def apply_message(self, conn: PointerToConnection, obj: SNetworkNode, msg_name: str, cfg: CallbackConfig,
+                      msg_data: tuple[...], record: bytes | None) -> None:
+        # record is the datagram of the update, only needed for RAM messages
+        info = self.connections.get(conn)
+        if self.objects.get(obj.oid) is not obj or info is None:
             return
 
-        if flags & Flags.RAM:
-            self.memory_handler.set_data(obj.oid, msg_name, msg_data, update_db=flags & Flags.Database != 0)
+        if info.schema_version != MsgRegistry.SchemaVersion:
+            # Handlers and the RAM state only ever see the arguments of the current schema
+            msg_data = self.get_transcoder(info.schema_version).upgrade(obj.ClassNumber, msg_name, msg_data)
+            if msg_data is None:
+                self.notify.warning(f'Dropped message {msg_name} from client {self.get_connection_descriptor(conn)}, '
+                                    f'it cannot be converted from schema version {info.schema_version}')
+                return
+            typedef = MsgRegistry.TypeIndex[obj.ClassNumber]
+            cfg = typedef.configurations[typedef.get_message_number(msg_name)]
+
+        message = conn, obj, msg_name, cfg, msg_data, record
+        if cfg.flags & Flags.Deferred:
+            # The RAM state is still changed on the main loop, in order with the other messages of the object
+            if cfg.flags & Flags.RAM and not self.deferred.queue_behind(obj.oid, msg_name, self.store_message, message):
+                self.store_message(*message)
+            self.deferred.submit(obj.oid, msg_name, getattr(obj, f'do_{msg_name}'), msg_data)
+        elif not self.deferred.queue_behind(obj.oid, msg_name, self.run_message, message):
+            self.run_message(*message)
+
+    def run_message(self, conn: PointerToConnection, obj: SNetworkNode, msg_name: str, cfg: CallbackConfig,
+                    msg_data: tuple[...], record: bytes | None) -> None:
+        # The object or the connection may be gone if the message was queued behind deferred handlers
+        if self.objects.get(obj.oid) is not obj or conn not in self.connections:
+            return
 
+        self.store_message(conn, obj, msg_name, cfg, msg_data, record)
         getattr(obj, f'do_{msg_name}')(*msg_data)
 
+    def store_message(self, conn: PointerToConnection, obj: SNetworkNode, msg_name: str, cfg: CallbackConfig,
+                      msg_data: tuple[...], record: bytes | None) -> None:
+        info = self.connections.get(conn)
+        if not cfg.flags & Flags.RAM or info is None or self.objects.get(obj.oid) is not obj:
+            return
+
+        # The datagram is the update itself, so it is journaled as is unless it came from an older schema
+        if info.schema_version != MsgRegistry.SchemaVersion:
+            record = None
+        self.memory_handler.set_data(obj.oid, msg_name, msg_data,
+                                     update_db=cfg.flags & Flags.Database == Flags.Database,
+                                     class_number=obj.ClassNumber, record=record)
+
+    def start_remote_call(self, conn: PointerToConnection, call_id: int, obj: SNetworkNode, message_number: int,
+                          data: bytes) -> bool:
+        message = self.check_message(conn, obj, message_number, remote_call=True)
+        if message is None:
+            return False
+
+        msg_name, cfg = message
+        bucket = self.get_exceeded_bucket(conn, obj, msg_name, cfg)
+        if bucket is not None:
+            outcome = self.limit_message(conn, bucket, f'{obj.__class__.__name__}.{msg_name}',
+                                         lambda: self.run_remote_call(conn, call_id, obj, msg_name, cfg,
+                                                                      self.rpc.unpack_args(cfg, data)))
+            if outcome == 'dropped':
+                self.rpc.reject(conn, call_id, RpcStatus.RateLimited, 'Rate limited')
+            return outcome != 'kicked'
+
+        self.run_remote_call(conn, call_id, obj, msg_name, cfg, self.rpc.unpack_args(cfg, data))
+        return True
+
+    def run_remote_call(self, conn: PointerToConnection, call_id: int, obj: SNetworkNode, msg_name: str,
+                        cfg: CallbackConfig, args: tuple[...]) -> None:
+        if self.objects.get(obj.oid) is not obj:
+            # Removed while the call was throttled
+            self.rpc.reject(conn, call_id, RpcStatus.Rejected, f'Unknown object {obj.oid}')
+            return
+        schema_version = self.connections[conn].schema_version
+        if schema_version != MsgRegistry.SchemaVersion:
+            # cfg stays the one of the client schema, which the results are packed with
+            args = self.get_transcoder(schema_version).upgrade(obj.ClassNumber, msg_name, args)
+            if args is None:
+                self.rpc.reject(conn, call_id, RpcStatus.Rejected,
+                                f'{msg_name} cannot be converted from schema version {schema_version}')
+                return
+        if not cfg.flags & Flags.Deferred:
+            if not self.deferred.queue_behind(obj.oid, msg_name, super().run_remote_call,
+                                              (conn, call_id, obj, msg_name, cfg, args)):
+                super().run_remote_call(conn, call_id, obj, msg_name, cfg, args)
+            return
+
+        result = RpcFuture()
+        handler = getattr(obj, f'do_{msg_name}')
+
+        def run_handler(*handler_args) -> None:
+            # The result is set on the main loop after the sends of the handler, so the caller sees them first
+            try:
+                value = handler(*handler_args)
+            except Exception as e:
+                self.deferred.capture(result.set_exception, e)
+            else:
+                self.deferred.capture(result.set_result, value)
+
+        self.deferred.submit(obj.oid, msg_name, run_handler, args)
+        self.rpc.complete(conn, call_id, cfg, result)
+
+    def send_rpc(self, obj: SNetworkNode, message_type: str, args: tuple[...], timeout: float = None,
+                 client: ObjectID = None) -> RpcFuture:
+        # Calls a client, the owner of obj by default. Calls from deferred handlers are sent from the main loop.
+        typedef = MsgRegistry.TypeIndex[obj.ClassNumber]
+        if typedef.configurations[typedef.get_message_number(message_type)].return_types is None:
+            raise ValueError(f'{message_type} is not a remote call')
+
+        future = RpcFuture()
+        client = obj.owner if client is None else client
+        if not self.deferred.capture(self.start_rpc, future, obj, message_type, args, timeout, client):
+            self.start_rpc(future, obj, message_type, args, timeout, client)
+        return future
+
+    def start_rpc(self, future: RpcFuture, obj: SNetworkNode, message_type: str, args: tuple[...],
+                  timeout: float | None, client: ObjectID) -> None:
+        conn = self.identified_connections.get(client)
+        if conn is None:
+            future.set_exception(ConnectionError(f'Client {client} is not connected'))
+            return
+
+        # The client may use an older schema, where the message has another number or layout or does not exist
+        schema_version = self.connections[conn].schema_version
+        if schema_version != MsgRegistry.SchemaVersion:
+            args = self.get_transcoder(schema_version).downgrade(obj.ClassNumber, message_type, args)
+            if args is None:
+                future.set_exception(RpcError(f'{message_type} cannot be sent to client {client}', RpcStatus.Rejected))
+                return
+        typedef = MsgRegistry.get_type_index(schema_version)[obj.ClassNumber]
+
+        message_number = typedef.get_message_number(message_type)
+        self.rpc.call(conn, obj.ClassNumber, obj.oid, message_number, message_type,
+                      typedef.configurations[message_number], args, timeout, future)
+
+    def flush_rpc(self) -> None:
+        self.rpc.expire()
+        self.rpc.flush(self.send_datagram)
+
+    def poll_rpc(self, task: Task):
+        self.flush_rpc()
+        return task.cont
@@ -0,0 +1,107 @@
+import selectors
+import socket
+import time
+
+from direct.directnotify.DirectNotifyGlobal import directNotify
+from direct.task.Task import Task
+from panda3d.core import Connection
+
+from libpuns.server.server_director import ServerMessageDirector
+
+
+class LoopTask:
+    # Stands for the Panda3D task passed to the polling functions, which only use it to return cont
+    cont = Task.cont
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+class ServerLoop:
+    # Runs a server without the Panda3D task manager, ShowBase or the builtins it installs. Instead of polling
+    # the connections every frame, the loop sleeps until a socket is readable (with epoll on Linux), a deferred
+    # handler or remote call completes, the next simulation tick is due, or tick seconds passed. Timers such as
+    # heartbeats, throttled messages and the journal are handled at least every tick.
+    notify = directNotify.newCategory('ServerLoop')
+
+    def __init__(self, director: ServerMessageDirector, tick: float = None):
+        self.director = director
+        self.tick = director.tick_scheduler.tick_length if tick is None else tick
+        self.selector = selectors.DefaultSelector()
+        self.tasks = [(function, LoopTask(name)) for function, name, sort in director.get_tasks()]
+        self.sockets = {}
+        self.known_connection_id = None
+        self.running = False
+        self.frames = 0
+        # Written to by other threads to interrupt the wait
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+
+    def run(self, port: int, warm_restart: bool = False) -> None:
+        rendezvous = self.director.open(port, warm_restart)
+        self.selector.register(self.get_fd(rendezvous), selectors.EVENT_READ)
+        self.director.on_drop = self.forget_socket
+        self.director.deferred.on_complete = self.wake
+        self.director.rpc.on_complete = self.wake
+        self.notify.warning(f'Launched server on port {port}')
+
+        self.running = True
+        try:
+            while self.running:
+                self.run_frame()
+                self.wait()
+        finally:
+            self.director.on_drop = self.director.deferred.on_complete = self.director.rpc.on_complete = None
+
+    def stop(self) -> None:
+        # Can be called from any thread or signal handler
+        self.running = False
+        self.wake()
+
+    def wake(self) -> None:
+        try:
+            self.wakeup_writer.send(b'\0')
+        except BlockingIOError:
+            # Already woken up
+            pass
+
+    def run_frame(self) -> None:
+        for function, task in self.tasks:
+            function(task)
+        self.update_sockets()
+        self.frames += 1
+
+    def wait(self) -> None:
+        timeout = min(self.tick, self.director.tick_scheduler.get_next_tick(time.monotonic()))
+        if self.director.reader_backlog:
+            # The datagrams left in the reader may have been read from the sockets already
+            timeout = 0
+        for key, events in self.selector.select(timeout):
+            if key.fileobj is self.wakeup_reader:
+                try:
+                    while self.wakeup_reader.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+
+    def update_sockets(self) -> None:
+        # Only a new connection ID means that connections were accepted
+        if self.director.next_connection_id == self.known_connection_id:
+            return
+
+        self.known_connection_id = self.director.next_connection_id
+        for conn in self.director.connections.keys() - self.sockets.keys():
+            fd = self.sockets[conn] = self.get_fd(conn)
+            self.selector.register(fd, selectors.EVENT_READ)
+
+    def forget_socket(self, conn: Connection) -> None:
+        # Panda3D may have closed the socket already, which removed it from epoll
+        fd = self.sockets.pop(conn, None)
+        if fd is not None:
+            self.selector.unregister(fd)
+
+    @staticmethod
+    def get_fd(conn: Connection) -> int:
+        return conn.getSocket().GetSocket()
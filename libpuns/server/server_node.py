@@ -1,4 +1,4 @@
-from typing import Optional, Protocol, Union
+from typing import Callable, Optional, Protocol, Union
 
 from direct.distributed.PyDatagram import PyDatagram
 
@@ -12,11 +12,35 @@ class SDirectorProto(DirectorProto, Protocol):
                          bypass_zone_required: bool = False) -> None:
         ...
 
+    def send_node_update(self, obj: 'SNetworkNode', message_type: str, args: tuple[...], **kwargs) -> None:
+        ...
+
+    def add_tick_callback(self, obj: 'SNetworkNode', callback: Callable[[int, float], None]) -> None:
+        ...
+
+    def remove_tick_callback(self, obj: 'SNetworkNode', callback: Callable[[int, float], None]) -> None:
+        ...
+
+    def run_on_main_loop(self, callback: Callable[..., None], *args) -> None:
+        ...
+
 
 class SNetworkNode(NetworkNode):
     director: SDirectorProto
     owner: Optional[ObjectID] = None
 
+    def send_update(self, message_type: str, *args, **kwargs) -> None:
+        self.director.send_node_update(self, message_type, args, **kwargs)
+
+    def add_tick_callback(self, callback: Callable[[int, float], None]) -> None:
+        self.director.add_tick_callback(self, callback)
+
+    def remove_tick_callback(self, callback: Callable[[int, float], None]) -> None:
+        self.director.remove_tick_callback(self, callback)
+
+    def run_on_main_loop(self, callback: Callable[..., None], *args) -> None:
+        self.director.run_on_main_loop(callback, *args)
+
     def transfer_owner(self, new_owner: ObjectID) -> None:
         self.owner = new_owner
 
@@ -0,0 +1,119 @@
+import ast
+import hashlib
+import hmac
+import marshal
+import os
+import sqlite3
+from typing import Iterable
+
+from libpuns.connection.datagram_util import ObjectID
+from libpuns.server.database_interface import DatabaseInterface, ObjectData
+
+
+def encode_oid(oid: ObjectID) -> str:
+    return repr(oid)
+
+
+def decode_oid(oid: str) -> ObjectID:
+    return ast.literal_eval(oid)
+
+
+def encode_value(value) -> bytes:
+    # Field values are tuples of ints, floats, strings and ObjectIDs, which marshal handles quickly.
+    # The format version is pinned so that the database can be read by newer Python versions.
+    return marshal.dumps(value, 4)
+
+
+def decode_value(value: bytes):
+    return marshal.loads(value)
+
+
+def hash_token(token: str, salt: bytes) -> bytes:
+    return hashlib.pbkdf2_hmac('sha256', token.encode('utf-8'), salt, 100000)
+
+
+class SQLiteDatabaseInterface(DatabaseInterface):
+    # Reference local backend. ObjectIDs are stored as Python literals and field values are marshalled,
+    # the snapshot keeps one row per object so that a warm restart reads as few rows as possible.
+    Schema = '''
+        CREATE TABLE IF NOT EXISTS accounts (login TEXT PRIMARY KEY, salt BLOB, token BLOB, oid TEXT);
+        CREATE TABLE IF NOT EXISTS objects (oid TEXT PRIMARY KEY, zone INTEGER);
+        CREATE INDEX IF NOT EXISTS objects_zone ON objects (zone);
+        CREATE TABLE IF NOT EXISTS fields (oid TEXT, field TEXT, value BLOB, PRIMARY KEY (oid, field));
+        CREATE TABLE IF NOT EXISTS snapshot (oid TEXT PRIMARY KEY, data BLOB);
+        CREATE TABLE IF NOT EXISTS zone_state (zone INTEGER PRIMARY KEY, data BLOB);
+    '''
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.Schema)
+
+    def create_account(self, login: str, token: str, oid: ObjectID) -> None:
+        salt = os.urandom(16)
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO accounts VALUES (?, ?, ?, ?)',
+                            (login, salt, hash_token(token, salt), encode_oid(oid)))
+
+    def attempt_login(self, login: str, token: str) -> ObjectID | None:
+        row = self.db.execute('SELECT salt, token, oid FROM accounts WHERE login = ?', (login, )).fetchone()
+        if row is None or not hmac.compare_digest(hash_token(token, row[0]), row[1]):
+            return None
+        return decode_oid(row[2])
+
+    def update_object(self, oid: ObjectID, field: str, value):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO fields VALUES (?, ?, ?)',
+                            (encode_oid(oid), field, encode_value(value)))
+
+    def collect_fields(self, rows: Iterable[tuple[str, str, bytes]]) -> dict[ObjectID, ObjectData]:
+        objects = {}
+        for oid, field, value in rows:
+            objects.setdefault(decode_oid(oid), {})[field] = decode_value(value)
+        return objects
+
+    def load_object(self, oid: ObjectID) -> ObjectData | None:
+        return self.load_objects([oid]).get(oid)
+
+    def load_objects(self, oids: Iterable[ObjectID]) -> dict[ObjectID, ObjectData]:
+        keys = [encode_oid(oid) for oid in oids]
+        objects = {}
+        # Stay below the SQLite host parameter limit
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self.db.execute(f'SELECT oid, field, value FROM fields WHERE oid IN ({",".join("?" * len(chunk))})',
+                                   chunk)
+            objects.update(self.collect_fields(rows))
+        return objects
+
+    def set_object_zone(self, oid: ObjectID, zone: int) -> None:
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO objects VALUES (?, ?)', (encode_oid(oid), zone))
+
+    def load_zone(self, zone: int) -> dict[ObjectID, ObjectData]:
+        rows = self.db.execute('SELECT fields.oid, field, value FROM fields '
+                               'JOIN objects ON objects.oid = fields.oid WHERE zone = ?', (zone, ))
+        return self.collect_fields(rows)
+
+    def save_snapshot(self, memory: dict[ObjectID, ObjectData]) -> None:
+        rows = ((encode_oid(oid), encode_value(fields)) for oid, fields in memory.items())
+        with self.db:
+            self.db.execute('DELETE FROM snapshot')
+            self.db.executemany('INSERT INTO snapshot VALUES (?, ?)', rows)
+
+    def load_snapshot(self) -> dict[ObjectID, ObjectData]:
+        rows = self.db.execute('SELECT oid, data FROM snapshot')
+        return {decode_oid(oid): decode_value(data) for oid, data in rows}
+
+    def save_zone_state(self, zone: int, data: bytes) -> None:
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO zone_state VALUES (?, ?)', (zone, data))
+
+    def load_zone_state(self, zone: int) -> bytes | None:
+        with self.db:
+            row = self.db.execute('SELECT data FROM zone_state WHERE zone = ?', (zone, )).fetchone()
+            if row is None:
+                return None
+            self.db.execute('DELETE FROM zone_state WHERE zone = ?', (zone, ))
+        return row[0]
@@ -0,0 +1,71 @@
+import time
+from typing import Callable
+
+from direct.directnotify.DirectNotifyGlobal import directNotify
+
+from libpuns.connection.datagram_util import ObjectID
+
+
+TickCallback = Callable[[int, float], None]
+
+
+class TickScheduler:
+    # Fixed-timestep simulation clock. Callbacks are called with (tick number, tick length in seconds)
+    # exactly tick_rate times per second of wall time, no matter how often update() is polled.
+    callbacks: dict[ObjectID | None, list[TickCallback]]
+    notify = directNotify.newCategory('TickScheduler')
+
+    def __init__(self, tick_rate: int = 30, max_catch_up: int = 5):
+        self.tick_rate = tick_rate
+        self.tick_length = 1 / tick_rate
+        self.max_catch_up = max_catch_up
+        self.callbacks = {}
+        self.tick = 0
+        self.accumulator = 0.0
+        self.last_time = None
+
+    def add_callback(self, callback: TickCallback, oid: ObjectID = None) -> None:
+        self.callbacks.setdefault(oid, []).append(callback)
+
+    def remove_callback(self, callback: TickCallback, oid: ObjectID = None) -> None:
+        callbacks = self.callbacks.get(oid)
+        if callbacks and callback in callbacks:
+            callbacks.remove(callback)
+            if not callbacks:
+                del self.callbacks[oid]
+
+    def remove_object(self, oid: ObjectID) -> None:
+        self.callbacks.pop(oid, None)
+
+    def get_time(self) -> float:
+        return self.tick * self.tick_length
+
+    def get_next_tick(self, now: float = None) -> float:
+        # Seconds until update() runs the next tick
+        if self.last_time is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        return max(self.tick_length - self.accumulator - (now - self.last_time), 0.0)
+
+    def update(self, now: float = None) -> int:
+        now = time.monotonic() if now is None else now
+        if self.last_time is None:
+            self.last_time = now
+        self.accumulator += now - self.last_time
+        self.last_time = now
+
+        ticks = 0
+        while self.accumulator >= self.tick_length:
+            if ticks == self.max_catch_up:
+                skipped = int(self.accumulator / self.tick_length)
+                self.notify.warning(f'Simulation is falling behind, skipping {skipped} ticks')
+                self.accumulator -= skipped * self.tick_length
+                break
+
+            self.accumulator -= self.tick_length
+            self.tick += 1
+            ticks += 1
+            for callbacks in list(self.callbacks.values()):
+                for callback in list(callbacks):
+                    callback(self.tick, self.tick_length)
+        return ticks
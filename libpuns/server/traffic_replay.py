@@ -0,0 +1,171 @@
+import argparse
+import importlib
+import time
+from typing import Callable
+
+from direct.directnotify.DirectNotifyGlobal import directNotify
+from direct.distributed.PyDatagramIterator import PyDatagramIterator
+from panda3d.core import Datagram, NetAddress
+
+from libpuns.connection.connection_globals import SpecialMessage
+from libpuns.connection.datagram_util import extract_object_id
+from libpuns.connection.message_registry import MsgRegistry
+from libpuns.connection.traffic_recorder import TrafficRecorder, RecordKind
+from libpuns.server.server_director import ServerMessageDirector
+
+notify = directNotify.newCategory('TrafficReplay')
+
+
+class ReplayConnection:
+    # Stands for a recorded connection, the director only uses connections as keys and for their address
+    def __init__(self, connection_id: int):
+        self.connection_id = connection_id
+
+    def getAddress(self) -> NetAddress:
+        return NetAddress()
+
+
+class ReplayTransport:
+    # Replaces the connection writer and manager of the replayed director, counts what it would send
+    def __init__(self):
+        self.datagrams = 0
+        self.bytes = 0
+
+    def send(self, datagram: Datagram, connection: ReplayConnection) -> bool:
+        self.datagrams += 1
+        self.bytes += datagram.getLength()
+        return True
+
+    def closeConnection(self, connection: ReplayConnection) -> bool:
+        return True
+
+
+class ReplayStats:
+    latencies: dict[str, list[float]]
+
+    def __init__(self):
+        self.latencies = {}
+        self.inbound = self.inbound_bytes = 0
+        self.recorded_outbound = self.recorded_outbound_bytes = 0
+        self.replayed_outbound = self.replayed_outbound_bytes = 0
+        self.elapsed = 0.0
+
+    def add(self, message_name: str, size: int, latency: float) -> None:
+        self.inbound += 1
+        self.inbound_bytes += size
+        self.latencies.setdefault(message_name, []).append(latency)
+
+    def report(self) -> str:
+        elapsed = self.elapsed or 1e-9
+        lines = [
+            f'Replayed {self.inbound} datagrams ({self.inbound_bytes / 2 ** 20:.2f} MiB) in {self.elapsed:.2f}s: '
+            f'{self.inbound / elapsed:,.0f} datagrams/s, {self.inbound_bytes / 2 ** 20 / elapsed:.2f} MiB/s',
+            f'Outbound: {self.replayed_outbound} datagrams ({self.replayed_outbound_bytes} bytes) replayed, '
+            f'{self.recorded_outbound} datagrams ({self.recorded_outbound_bytes} bytes) recorded',
+            f'{"Message":<32} {"Count":>8} {"Mean us":>9} {"p50 us":>9} {"p99 us":>9} {"Max us":>9}',
+        ]
+        for name, latencies in sorted(self.latencies.items(), key=lambda item: -sum(item[1])):
+            latencies = sorted(latencies)
+            count = len(latencies)
+            lines.append(f'{name:<32} {count:>8} {sum(latencies) / count * 1e6:>9.1f} '
+                         f'{latencies[count // 2] * 1e6:>9.1f} {latencies[min(count - 1, count * 99 // 100)] * 1e6:>9.1f} '
+                         f'{latencies[-1] * 1e6:>9.1f}')
+        return '\n'.join(lines)
+
+
+def get_message_name(datagram: Datagram, schema_version: int) -> str:
+    pdi = PyDatagramIterator(datagram)
+    message_type = pdi.getUint16()
+    if message_type in SpecialMessage.__members__.values():
+        return SpecialMessage(message_type).name
+
+    cls = MsgRegistry.ServerIndex.get(message_type)
+    class_name = cls.__name__ if cls is not None else f'Class {message_type}'
+    typedef = MsgRegistry.get_type_index(schema_version).get(message_type)
+    try:
+        extract_object_id(pdi)
+        return f'{class_name}.{typedef.get_message_name(pdi.getUint16())}'
+    except (AssertionError, AttributeError, KeyError):
+        # Malformed, the director will kick the client for it
+        return class_name
+
+
+def replay(director: ServerMessageDirector, path: str, realtime: bool = False) -> ReplayStats:
+    # Feeds the recording into a director that was not launched. Ticks follow the recorded timestamps, so the
+    # replay is deterministic unless Flags.Deferred handlers are involved. Connections are never reaped.
+    schema_version, records = TrafficRecorder.read(path)
+    director.compile_signature()
+    if schema_version != MsgRegistry.SchemaVersion:
+        notify.warning(f'Recorded with schema version {schema_version}, replaying with {MsgRegistry.SchemaVersion}')
+
+    transport = director.writer = director.connman = ReplayTransport()
+    connections = {}
+    stats = ReplayStats()
+    start = time.perf_counter()
+    tick_time = 0.0
+    for timestamp, kind, connection_id, data in records:
+        if realtime:
+            delay = start + timestamp - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        # A running server polls every frame, so quiet periods of the recording are simulated tick by tick
+        while tick_time + director.tick_scheduler.tick_length < timestamp:
+            tick_time += director.tick_scheduler.tick_length
+            director.run_ticks(tick_time)
+        director.run_ticks(timestamp)
+        director.deferred.poll()
+        if director.throttled:
+            director.release_throttled(time.monotonic())
+        director.flush_rpc()
+
+        if kind == RecordKind.Opened:
+            conn = connections[connection_id] = ReplayConnection(connection_id)
+            director.accept_connection(conn)
+        elif kind == RecordKind.Closed:
+            conn = connections.pop(connection_id, None)
+            if conn is not None:
+                director.drop_connection(conn)
+        elif kind == RecordKind.Inbound:
+            conn = connections.get(connection_id)
+            info = director.connections.get(conn)
+            if info is None:
+                continue
+
+            datagram = Datagram(data)
+            message_name = get_message_name(datagram, info.schema_version)
+            handle_start = time.perf_counter()
+            director.handle_datagram(conn, datagram)
+            stats.add(message_name, len(data), time.perf_counter() - handle_start)
+        else:
+            stats.recorded_outbound += 1
+            stats.recorded_outbound_bytes += len(data)
+
+    while director.deferred.pending:
+        director.deferred.poll()
+        time.sleep(0.001)
+    director.flush_rpc()
+    stats.elapsed = time.perf_counter() - start
+    stats.replayed_outbound = transport.datagrams
+    stats.replayed_outbound_bytes = transport.bytes
+    return stats
+
+
+def load_factory(name: str) -> Callable[[], ServerMessageDirector]:
+    module_name, _, attribute = name.partition(':')
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Replays a traffic recording into a fresh ServerMessageDirector')
+    parser.add_argument('recording')
+    parser.add_argument('factory', help='module:function configuring the registry and returning the director')
+    parser.add_argument('--realtime', action='store_true', help='keep the recorded pace instead of replaying '
+                                                                'as fast as possible')
+    args = parser.parse_args()
+
+    director = load_factory(args.factory)()
+    print(replay(director, args.recording, args.realtime).report())
+
+
+if __name__ == '__main__':
+    main()
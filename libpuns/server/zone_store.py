@@ -0,0 +1,30 @@
+import os
+
+
+class ZoneStore:
+    # Keeps the state of evicted zones as one file per zone, for database backends without zone eviction support
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, zone: int) -> str:
+        return os.path.join(self.directory, f'zone-{zone}.bin')
+
+    def save_zone_state(self, zone: int, data: bytes) -> None:
+        path = self.get_path(zone)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def load_zone_state(self, zone: int) -> bytes | None:
+        # Returns the state saved by save_zone_state and deletes it
+        path = self.get_path(zone)
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.remove(path)
+        return data
@@ -0,0 +1,57 @@
+import threading
+import time
+
+import pytest
+
+from libpuns.server.deferred_executor import DeferredExecutor
+
+
+def wait_for_completion(executor: DeferredExecutor) -> None:
+    deadline = time.monotonic() + 5
+    while executor.completed.empty():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def fail(message: str) -> None:
+    raise RuntimeError(message)
+
+
+def test_queued_main_loop_handlers_raise_and_the_queue_continues():
+    executor = DeferredExecutor(1)
+    release = threading.Event()
+    ran = []
+    executor.submit(1, 'slow', release.wait, ())
+    executor.queue_behind(1, 'broken', fail, ('broken', ))
+    executor.queue_behind(1, 'after', ran.append, ('after', ))
+    executor.submit(1, 'deferred', ran.append, ('deferred', ))
+
+    release.set()
+    wait_for_completion(executor)
+    with pytest.raises(RuntimeError):
+        executor.poll()
+    assert ran == ['after']
+
+    wait_for_completion(executor)
+    executor.poll()
+    assert ran == ['after', 'deferred']
+    assert not executor.pending
+
+
+def test_failed_replayed_sends_still_start_the_next_handler():
+    executor = DeferredExecutor(1)
+    ran = []
+
+    def send_and_fail():
+        executor.capture(fail, 'send')
+
+    executor.submit(1, 'send', send_and_fail, ())
+    executor.submit(1, 'next', ran.append, ('next', ))
+    wait_for_completion(executor)
+    with pytest.raises(RuntimeError):
+        executor.poll()
+
+    wait_for_completion(executor)
+    executor.poll()
+    assert ran == ['next']
+    assert not executor.pending
@@ -0,0 +1,73 @@
+from direct.distributed.PyDatagram import PyDatagram
+from panda3d.core import Datagram
+
+from libpuns.connection.connection_globals import SpecialMessage, SupportedCapabilities
+from libpuns.connection.message_registry import CallbackObject, Flags, MsgRegistry
+from libpuns.connection.packers import Int32
+from libpuns.connection.rpc import RpcStatus
+from libpuns.server.database_interface import DummyDatabaseInterface
+from libpuns.server.server_director import ServerMessageDirector
+from libpuns.server.server_node import SNetworkNode
+from libpuns.server.traffic_replay import ReplayConnection, ReplayTransport
+
+CallerClass = 200
+
+MsgRegistry.configure(CallerClass, [
+    CallbackObject('confirm', Flags.OwnerSend, (Int32(), ), returns=(Int32(), )),
+])
+
+
+class LoginDatabase(DummyDatabaseInterface):
+    def attempt_login(self, login: str, token: str) -> int:
+        return int(login)
+
+
+@MsgRegistry.server_class(CallerClass)
+class Caller(SNetworkNode):
+    pass
+
+
+def connect(server: ServerMessageDirector, connection_id: int, login: str = None) -> ReplayConnection:
+    conn = ReplayConnection(connection_id)
+    server.accept_connection(conn)
+    if login is not None:
+        dg = PyDatagram()
+        dg.addUint16(SpecialMessage.ConnectionRequest)
+        dg.addBlob(server.signature)
+        dg.addUint16(MsgRegistry.SchemaVersion)
+        dg.addUint32(SupportedCapabilities)
+        dg.addString(login)
+        dg.addString('')
+        server.handle_datagram(conn, Datagram(dg.getMessage()))
+    return conn
+
+
+def send_response(server: ServerMessageDirector, conn: ReplayConnection, call_id: int, value: int) -> None:
+    payload = PyDatagram()
+    payload.addInt32(value)
+    dg = PyDatagram()
+    dg.addUint16(SpecialMessage.RpcResponse)
+    dg.addUint16(1)
+    dg.addUint32(call_id)
+    dg.addUint8(RpcStatus.Ok)
+    dg.addUint16(payload.getLength())
+    dg.appendData(payload.getMessage())
+    server.handle_datagram(conn, Datagram(dg.getMessage()))
+
+
+def test_responses_are_only_accepted_from_the_called_connection():
+    server = ServerMessageDirector(LoginDatabase(), Caller)
+    server.compile_signature()
+    server.writer = server.connman = ReplayTransport()
+    callee = connect(server, 1, '1')
+    player = connect(server, 2, '2')
+    anonymous = connect(server, 3)
+
+    future = server.objects[1].call('confirm', 5)
+    call_id, = server.rpc.calls
+    send_response(server, player, call_id, 666)
+    send_response(server, anonymous, call_id, 667)
+    assert not future.done()
+
+    send_response(server, callee, call_id, 5)
+    assert future.result(0) == 5
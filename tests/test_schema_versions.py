@@ -0,0 +1,170 @@
+from direct.distributed.PyDatagram import PyDatagram
+from direct.distributed.PyDatagramIterator import PyDatagramIterator
+from panda3d.core import Datagram
+
+from libpuns.connection.connection_globals import SpecialMessage, SupportedCapabilities
+from libpuns.connection.datagram_util import add_object_id, extract_object_id
+from libpuns.connection.message_registry import Flags, MsgRegistry
+from libpuns.connection.packers import Int32, String
+from libpuns.server.database_interface import DummyDatabaseInterface
+from libpuns.server.server_director import ServerMessageDirector
+from libpuns.server.server_node import SNetworkNode
+from libpuns.server.traffic_replay import ReplayConnection, ReplayTransport
+
+PlayerClass = 100
+Flag = Flags.OwnerSend | Flags.RAM
+
+# Version 1 clients send one coordinate, the server expects two; rename gained an argument without any hooks
+MsgRegistry.set_schema_version(2)
+with MsgRegistry.legacy_schema(1):
+    MsgRegistry.configure(PlayerClass, [
+        ('move', Flag, (Int32(), )),
+        ('rename', Flag, (String(), )),
+        ('say', Flags.OwnerSend, (String(), )),
+    ])
+    MsgRegistry.convert(PlayerClass, 'move', upgrade=lambda x: (x, 0), downgrade=lambda x, y: (x, ))
+
+MsgRegistry.configure(PlayerClass, [
+    ('move', Flag, (Int32(), Int32())),
+    ('rename', Flag, (String(), Int32())),
+    ('say', Flags.OwnerSend, (String(), )),
+])
+
+
+class LoginDatabase(DummyDatabaseInterface):
+    def attempt_login(self, login: str, token: str) -> int:
+        return int(login)
+
+
+@MsgRegistry.server_class(PlayerClass)
+class Player(SNetworkNode):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received = []
+
+    def do_move(self, x: int, y: int) -> None:
+        self.received.append(('move', x, y))
+
+    def do_rename(self, name: str, flags: int) -> None:
+        self.received.append(('rename', name, flags))
+
+    def do_say(self, text: str) -> None:
+        self.received.append(('say', text))
+
+
+class CapturingTransport(ReplayTransport):
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    def send(self, datagram: Datagram, connection: ReplayConnection) -> bool:
+        self.sent.append(datagram.getMessage())
+        return super().send(datagram, connection)
+
+
+def connect_legacy_client() -> tuple[ServerMessageDirector, ReplayConnection, CapturingTransport]:
+    server = ServerMessageDirector(LoginDatabase(), Player)
+    server.compile_signature()
+    transport = server.writer = server.connman = CapturingTransport()
+    conn = ReplayConnection(1)
+    server.accept_connection(conn)
+
+    dg = PyDatagram()
+    dg.addUint16(SpecialMessage.ConnectionRequest)
+    dg.addBlob(MsgRegistry.get_version_signature(1))
+    dg.addUint16(1)
+    dg.addUint32(SupportedCapabilities)
+    dg.addString('1')
+    dg.addString('')
+    server.handle_datagram(conn, Datagram(dg.getMessage()))
+    request_zone(server, conn)
+    return server, conn, transport
+
+
+def request_zone(server: ServerMessageDirector, conn: ReplayConnection) -> None:
+    dg = PyDatagram()
+    dg.addUint16(SpecialMessage.ZoneRequest)
+    dg.addUint32(0)
+    dg.addUint16(0)
+    server.handle_datagram(conn, Datagram(dg.getMessage()))
+
+
+def send_legacy_update(server: ServerMessageDirector, conn: ReplayConnection, message: str, *args) -> None:
+    dg = PyDatagram()
+    dg.addUint16(PlayerClass)
+    add_object_id(dg, 1)
+    MsgRegistry.get_type_index(1)[PlayerClass].compile_datagram(message, *args, init_datagram=dg)
+    server.handle_datagram(conn, Datagram(dg.getMessage()))
+
+
+def read_legacy_updates(transport: CapturingTransport) -> list[tuple[str, tuple[...]]]:
+    updates = []
+    for message in transport.sent:
+        datagram = Datagram(message)
+        pdi = PyDatagramIterator(datagram)
+        if pdi.getUint16() == PlayerClass:
+            extract_object_id(pdi)
+            updates.append(MsgRegistry.get_type_index(1)[PlayerClass].decompile_datagram(pdi))
+    return updates
+
+
+def read_legacy_zone_fields(transport: CapturingTransport) -> dict[str, tuple[...]]:
+    fields = {}
+    for message in transport.sent:
+        datagram = Datagram(message)
+        pdi = PyDatagramIterator(datagram)
+        if pdi.getUint16() != SpecialMessage.ZoneData:
+            continue
+
+        pdi.getUint32()
+        for i in range(pdi.getUint16()):
+            extract_object_id(pdi)
+        for i in range(pdi.getUint16()):
+            extract_object_id(pdi)
+            pdi.getUint16()
+            pdi.getUint32()
+            for j in range(pdi.getUint16()):
+                name, args = MsgRegistry.get_type_index(1)[PlayerClass].decompile_datagram(pdi)
+                fields[name] = args
+    return fields
+
+
+def test_legacy_updates_are_upgraded():
+    server, conn, transport = connect_legacy_client()
+    send_legacy_update(server, conn, 'move', 7)
+    send_legacy_update(server, conn, 'say', 'hello')
+
+    player = server.objects[1]
+    assert player.received == [('move', 7, 0), ('say', 'hello')]
+    assert server.memory_handler.get_data(1, 'move') == (7, 0)
+    assert conn in server.connections
+
+
+def test_legacy_updates_without_hook_are_dropped():
+    server, conn, transport = connect_legacy_client()
+    send_legacy_update(server, conn, 'rename', 'bob')
+
+    assert server.objects[1].received == []
+    assert server.memory_handler.get_data(1, 'rename') is None
+    assert conn in server.connections
+
+
+def test_updates_are_downgraded_for_legacy_clients():
+    server, conn, transport = connect_legacy_client()
+    transport.sent.clear()
+    player = server.objects[1]
+    player.send_update('move', 3, 4)
+    player.send_update('rename', 'alice', 1)
+    player.send_update('say', 'hi')
+
+    assert read_legacy_updates(transport) == [('move', (3, )), ('say', ('hi', ))]
+
+
+def test_zone_data_is_downgraded_for_legacy_clients():
+    server, conn, transport = connect_legacy_client()
+    send_legacy_update(server, conn, 'move', 5)
+    server.memory_handler.set_data(1, 'rename', ('carol', 2))
+    transport.sent.clear()
+    request_zone(server, conn)
+
+    assert read_legacy_zone_fields(transport) == {'move': (5, )}